@@ -1,27 +1,76 @@
 import re
 import time
-import json
-import stripe
+import logs
 import logging
-import pymongo
 import asyncio
-import schedule
-import requests
+import metrics
+import reports
+import functools
+import itertools
+import schema
 import database
 import threading
-import pyshorteners
-from stripe.error import (
-    StripeError
+from urllib.parse import (
+    urlparse
 )
-from typing import (
-    List, Dict
+from repository import (
+    repository
+)
+from catalog import (
+    product_id
+)
+from cart import (
+    add_item,
+    clear_cart,
+    describe_cart,
+    encode_items,
+    get_cart,
+    quantity_in_cart
+)
+from payments import (
+    checkout,
+    CheckoutError
+)
+from config import (
+    settings,
+    ConfigError,
+    REQUIRED
+)
+from reaper import (
+    reaper
+)
+from pricing import (
+    format_amount,
+    pricing,
+    to_cents,
+    Quote
+)
+from webhooks import (
+    verify_event,
+    WebhookQueue
+)
+from shortlinks import (
+    short_links,
+    shorten_external,
+    SHORT_LINK_PREFIX
+)
+from persistence import (
+    build_persistence
 )
-from stripe import (
-    Webhook
+from telegram_ingress import (
+    TelegramIngress,
+    TELEGRAM_WEBHOOK_PATH
+)
+from notifications import (
+    OrderFeed,
+    NotificationSender
+)
+from typing import (
+    List, Dict, Optional
 )
 from http.server import (
     BaseHTTPRequestHandler, 
-    HTTPServer
+    ThreadingHTTPServer
 )
 from telegram import (
     ReplyKeyboardMarkup, 
@@ -41,29 +90,40 @@ from telegram.ext import (
     ConversationHandler,
     filters,
     PreCheckoutQueryHandler,
+    TypeHandler,
 )
 
-# Enable logging
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
+# Enable logging; records are written by a background thread, see logs.py
+logs.configure_logging()
 logger = logging.getLogger(__name__)
 
-# Define order telegram bot
-ORDER_BOT_KEY = ""
-# Define notification telegram bot
-NOTIFICATION_BOT_KEY = ""
-# Define staff telegram chat channel id for notifications to be sent to
-STAFF_CHANNEL_ID = ""
-# Define stripe api key
-# real stripe.api_key = "" - use the test key for testing purposes below
-stripe.api_key = ""
+# Bot tokens, the staff channel, Stripe keys and the webhook secret are read from
+# the environment or a config file, see config.py
 
 # Define user conversation states
-START, PRODUCT, ORDER_QUANTITY, OPTION, PICKUP, DELIVERY_ADDRESS, NAME, CONFIRM, PROCESS_PAYMENT = range(9)
+START, PRODUCT, ORDER_QUANTITY, OPTION, PICKUP, DELIVERY_ADDRESS, NAME, CONFIRM, PROCESS_PAYMENT, CART = range(10)
+
+# Readable state names for the funnel metrics
+metrics.STATE_NAMES.update({
+    START: 'start', PRODUCT: 'product', ORDER_QUANTITY: 'order_quantity', OPTION: 'option', PICKUP: 'pickup',
+    DELIVERY_ADDRESS: 'delivery_address', NAME: 'name', CONFIRM: 'confirm', PROCESS_PAYMENT: 'process_payment',
+    CART: 'cart', ConversationHandler.END: 'end',
+})
+
+# Define product selection callback data and paging
+PRODUCT_CALLBACK_PREFIX = "product:"
+PAGE_CALLBACK_PREFIX = "page:"
+PRODUCTS_PER_PAGE = 8
+
+# Define cart callback data
+CART_ADD, CART_CHECKOUT = "cart:add", "cart:checkout"
+
+# Define how many report rows are sent per message
+REPORT_BATCH_SIZE = 25
 
 class TelegramBotHandler:
     # Define command handlers
+    @metrics.handler
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Send a welcome message when the command /start is issued."""
         user = update.message.from_user
@@ -71,6 +131,7 @@ class TelegramBotHandler:
         context.user_data['state'] = START
         return context.user_data.get('state')
 
+    @metrics.handler
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle the /help command."""
         help_text = """
@@ -82,6 +143,7 @@ class TelegramBotHandler:
         """
         await update.message.reply_text(text=help_text)
 
+    @metrics.handler
     async def handle_invalid_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         user_input = update.message.text
 
@@ -104,31 +166,67 @@ class TelegramBotHandler:
             else:
                 await update.message.reply_text(text="Invalid input. Please try again or check /help for guidance.")
 
+    @metrics.handler
     async def show_products(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Display the available products to the user."""
-        # Retrieve the available products from the database
-        product_docs = database.products.find({"stock": {"$gt": 0}})
-        products_list = list(product_docs)
+        # Retrieve the available products from the cached catalog
+        products_list = await repository.available_products()
 
         if not products_list:
             await update.message.reply_text(text='No products available.')
             return
 
-        # Create inline keyboard with product buttons
-        keyboard = [[InlineKeyboardButton(f"€{product['price']} - {product['name']}", callback_data=product['name'])] for product in products_list]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        # Send message with product options
-        await update.message.reply_text(text='Please select a product:', reply_markup=reply_markup)
+        # Send message with the first page of product options
+        await update.message.reply_text(text='Please select a product:', reply_markup=self.product_keyboard(products_list, 0))
 
         context.user_data['state'] = PRODUCT
         return context.user_data.get('state')
-    
+
+    @metrics.handler
+    async def show_products_page(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        """Switch the product list to another page."""
+        query = update.callback_query
+        await query.answer()
+
+        products_list = await repository.available_products()
+        page = int(query.data[len(PAGE_CALLBACK_PREFIX):])
+        await query.edit_message_reply_markup(reply_markup=self.product_keyboard(products_list, page))
+        return PRODUCT
+
+    def product_keyboard(self, products_list: List[Dict], page: int) -> InlineKeyboardMarkup:
+        # Only build buttons for the requested page so large catalogs render quickly
+        pages = max(1, -(-len(products_list) // PRODUCTS_PER_PAGE))
+        page = min(max(page, 0), pages - 1)
+        start = page * PRODUCTS_PER_PAGE
+
+        # Create inline keyboard with product buttons
+        keyboard = [
+            [InlineKeyboardButton(f"{format_amount(to_cents(product['price']))} - {product['name']}", callback_data=PRODUCT_CALLBACK_PREFIX + product_id(product))]
+            for product in products_list[start:start + PRODUCTS_PER_PAGE]
+        ]
+
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton("« Previous", callback_data=f"{PAGE_CALLBACK_PREFIX}{page - 1}"))
+        if page < pages - 1:
+            navigation.append(InlineKeyboardButton("Next »", callback_data=f"{PAGE_CALLBACK_PREFIX}{page + 1}"))
+        if navigation:
+            keyboard.append(navigation)
+
+        return InlineKeyboardMarkup(keyboard)
+
+    @metrics.handler
     async def order_product(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         query = update.callback_query
         await query.answer()
 
-        product = query.data
+        # Look the product up by the id carried in the callback data
+        product_doc = await repository.get_product_by_id(query.data[len(PRODUCT_CALLBACK_PREFIX):])
+        if product_doc is None:
+            await query.edit_message_text(text="Selected product is not available. Please use /products to pick another one.")
+            return PRODUCT
+
+        product = product_doc['name']
 
         # Prompt the user to enter the quantity
         await query.edit_message_text(text=f"How many {product} do you want to order?")
@@ -138,6 +236,7 @@ class TelegramBotHandler:
         context.user_data['state'] = ORDER_QUANTITY
         return context.user_data.get('state')
 
+    @metrics.handler
     async def enter_quantity(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Process the entered quantity and store the selected product and quantity."""
         quantity_text = update.message.text
@@ -148,22 +247,50 @@ class TelegramBotHandler:
         quantity = int(quantity_text)
         product = context.user_data.get('product')
 
-        # Retrieve the stock for the selected product
-        product_doc = database.products.find_one({"name": product})
+        # Retrieve the stock for the selected product; the authoritative check happens on payment
+        product_doc = await repository.get_product(product)
 
         if product_doc is None:
             await update.message.reply_text(text="Selected product is not available.")
             return ORDER_QUANTITY  # Return to the same state to allow the user to select a valid product
 
-        stock = product_doc['stock']
+        # Units already in the cart count against the available stock
+        stock = product_doc['stock'] - quantity_in_cart(context.user_data, product)
 
         if quantity > stock:
-            await update.message.reply_text(text=f"Insufficient stock. Available stock for {product}: {stock}")
+            await update.message.reply_text(text=f"Insufficient stock. Available stock for {product}: {max(stock, 0)}")
             return ORDER_QUANTITY  # Return to the same state to allow the user to enter a valid quantity
 
-        # Store the selected quantity and product
-        context.user_data['quantity'] = quantity
-        context.user_data['product'] = product
+        # Add the selected quantity and product to the cart
+        add_item(context.user_data, product, quantity)
+
+        # Let the user keep shopping or move on to checkout
+        keyboard = [
+            [InlineKeyboardButton("Add another product", callback_data=CART_ADD)],
+            [InlineKeyboardButton("Checkout", callback_data=CART_CHECKOUT)]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await update.message.reply_text(text=f"Your cart: {describe_cart(get_cart(context.user_data))}", reply_markup=reply_markup)
+
+        context.user_data['state'] = CART
+        return context.user_data.get('state')
+
+    @metrics.handler
+    async def continue_shopping(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        """Show the product list again so another item can be added to the cart."""
+        query = update.callback_query
+        await query.answer()
+
+        products_list = await repository.available_products()
+        await query.edit_message_text(text='Please select a product:', reply_markup=self.product_keyboard(products_list, 0))
+
+        context.user_data['state'] = PRODUCT
+        return context.user_data.get('state')
+
+    @metrics.handler
+    async def ask_delivery_option(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        query = update.callback_query
+        await query.answer()
 
         """Prompt the user to select the delivery option."""
         keyboard = [
@@ -171,11 +298,12 @@ class TelegramBotHandler:
             [InlineKeyboardButton("Delivery", callback_data="delivery")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(text="Please select an option:", reply_markup=reply_markup)
+        await query.edit_message_text(text="Please select an option:", reply_markup=reply_markup)
 
         context.user_data['state'] = OPTION
         return context.user_data.get('state')
 
+    @metrics.handler
     async def select_delivery_method(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         query = update.callback_query
         delivery_method = query.data
@@ -197,10 +325,11 @@ class TelegramBotHandler:
 
         elif delivery_method == 'delivery':
             # Handle delivery logic
-            await query.edit_message_text(text="You have selected Delivery. Please be mindful that there is a €2 charge for delivery. Please provide your address for delivery:")
+            await query.edit_message_text(text=f"You have selected Delivery. Please be mindful that there is a {format_amount(pricing.delivery_fee)} charge for delivery. Please provide your address for delivery:")
             context.user_data['state'] = DELIVERY_ADDRESS
             return context.user_data.get('state')
 
+    @metrics.handler
     async def select_pickup_point(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         query = update.callback_query
         location = query.data
@@ -212,6 +341,7 @@ class TelegramBotHandler:
         context.user_data['state'] = NAME
         return context.user_data.get('state')
 
+    @metrics.handler
     async def provide_delivery_address(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         location = update.message.text
         context.user_data['location'] = location
@@ -219,6 +349,7 @@ class TelegramBotHandler:
         context.user_data['state'] = NAME
         return context.user_data.get('state')
 
+    @metrics.handler
     async def provide_name(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         name = update.message.text
         context.user_data['name'] = name
@@ -226,137 +357,239 @@ class TelegramBotHandler:
         context.user_data['state'] = CONFIRM
         return context.user_data.get('state')
 
+    @metrics.handler
     async def confirm_order(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         # Retrieve the captured data
-        product = context.user_data['product']
-        quantity = context.user_data.get('quantity')
+        cart = get_cart(context.user_data)
         option = context.user_data.get('delivery_method')
         location = context.user_data.get('location')
         name = context.user_data.get('name')
 
         # Send confirmation message
         confirmation_message = f"""
-        You've ordered {quantity} {product.upper()}(s), choosing the {option.upper()} option at location {location.upper()} in the name of {name.upper()}.
+        You've ordered {describe_cart(cart).upper()}, choosing the {option.upper()} option at location {location.upper()} in the name of {name.upper()}.
         If this is correct, please type CONFIRM to proceed to payment.
         """
         await update.message.reply_text(text=confirmation_message)
 
+    @metrics.handler
     async def process_payment(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-        # Retrieve the selected product from user context
-        product = context.user_data.get('product')
-        quantity = context.user_data.get('quantity')
+        # Retrieve the cart from user context
+        cart = get_cart(context.user_data)
         option = context.user_data.get('delivery_method')
         location = context.user_data.get('location')
 
-        # Retrieve the price for the selected product
-        product_doc = database.products.find_one({"name": product})
-        if product_doc is None:
+        if not cart:
+            await update.message.reply_text(text="Your cart is empty. Use /products to add something.")
             return ConversationHandler.END
 
-        extra_fees = 0
+        # Retrieve the price for every product in the cart
+        lines = []
+        for item in cart:
+            product_doc = await repository.get_product(item['product'])
+            if product_doc is None:
+                await update.message.reply_text(text=f"Sorry, {item['product']} is no longer available.")
+                return ConversationHandler.END
+            lines.append({'product': item['product'], 'quantity': item['quantity'], 'price': product_doc['price']})
+
+        # Price the order once, in cents; the same quote goes to the customer and to Stripe
+        quote = pricing.quote(lines, option, location)
+
+        # Hold the stock for as long as the checkout session stays open; the hold also
+        # records what each line is charged, for the sales reports
+        reservation_id = await repository.reserve(quote.items(), update.effective_user.id)
+        if reservation_id is None:
+            await update.message.reply_text(text="Sorry, there is no longer enough stock for this order.")
+            return ConversationHandler.END
+        logs.tag(order_id=reservation_id)
 
-        price = product_doc['price']
+        # Answer straight away and fill in the link once Stripe has created the session
+        message = await update.message.reply_text(text="Preparing your payment link…")
 
-        # Calculate final price
-        final_price = price * quantity
+        try:
+            session = await self.create_checkout_session(update.effective_user.id, quote, reservation_id, context)
+        except CheckoutError:
+            logger.exception("Could not create a checkout session")
+            await repository.release(reservation_id)
+            # The cart is kept, so the customer can check out again later
+            await message.edit_text(text="Sorry, we couldn't create your payment link. Please try again later.")
+            return ConversationHandler.END
+        logger.info("Created checkout session %s", session.id)
 
-        if option == "delivery":
-            final_price += 2
-            extra_fees += 2
+        # Expire the session and give the stock back if the customer never pays
+        await repository.run(database.reservations.attach_session, reservation_id, session.id, session.expires_at)
+        reaper.track_checkout(reservation_id, session.id, session.expires_at)
 
-        session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            line_items=[
-                {
-                    'price_data': {
-                        'currency': 'eur',
-                        'product_data': {
-                            'name': product,
-                        },
-                        'unit_amount': int((price + extra_fees) * 100),
+        # Get the payment URL from the session and shorten it
+        payment_url = await URLShortener.shorten_url(session.url, session.expires_at)
+
+        summary = f"Your order of {describe_cart(cart).upper()} totals to {format_amount(quote.total)}"
+        if quote.fee:
+            summary += f", including {format_amount(quote.fee)} for {quote.fee_name.lower()}"
+        if quote.discount:
+            summary += f", after a {format_amount(quote.discount)} volume discount"
+
+        text = f"""
+        \n{summary}.
+        \nYou've chosen {option.upper()} at {location.upper()}.
+        \nPlease click the link below to proceed with the payment:\n\n{payment_url}
+        """
+
+        await message.edit_text(text=text)
+        # The cart now belongs to the checkout session
+        clear_cart(context.user_data)
+        # await self.send_order_details_to_channel(context)
+        return ConversationHandler.END
+
+    async def create_checkout_session(self, user_id: int, quote: Quote, reservation_id: str, context: ContextTypes.DEFAULT_TYPE):
+        # The session expires together with the stock hold; the hold's default leaves
+        # headroom above Stripe's 30 minute minimum
+        expires_at = int(time.time()) + database.reservations.hold_seconds
+        cart = quote.items()
+        idempotency_key = checkout.idempotency_key(user_id, cart, reservation_id)
+        metadata = {
+            'option': context.user_data.get('delivery_method'),
+            'location': context.user_data.get('location'),
+            'name': context.user_data.get('name'),
+            'reservation_id': reservation_id,
+        }
+        # Very large carts don't fit in metadata; the webhook then reads them from the reservation
+        items = encode_items(cart)
+        if items is not None:
+            metadata['items'] = items
+
+        # One checkout line per cart line
+        line_items = [
+            {
+                'price_data': {
+                    'currency': 'eur',
+                    'product_data': {
+                        'name': line.product,
                     },
-                    'quantity': quantity,
+                    'unit_amount': line.unit_amount,
                 },
-            ],
+                'quantity': line.quantity,
+            }
+            for line in quote.lines
+        ]
+        if quote.fee:
+            line_items.append({
+                'price_data': {
+                    'currency': 'eur',
+                    'product_data': {
+                        'name': quote.fee_name,
+                    },
+                    'unit_amount': quote.fee,
+                },
+                'quantity': 1,
+            })
+
+        return await checkout.create_session(
+            idempotency_key,
+            payment_method_types=['card'],
+            line_items=line_items,
             mode='payment',
             success_url='https://yourwebsite.com/success',
             cancel_url='https://yourwebsite.com/cancel',
+            expires_at=expires_at,
+            client_reference_id=reservation_id,
+            # The webhook builds the order from the session's own metadata
+            metadata=metadata,
             payment_intent_data={
                 'capture_method': 'manual',
-                'metadata': {
-                    'product': product,
-                    'quantity': quantity,
-                    'option': context.user_data.get('delivery_method'),
-                    'location': context.user_data.get('location'),
-                    'name': context.user_data.get('name'),
-                },
+                'metadata': metadata,
             },
         )
 
-        # Get the payment URL from the session and shorten it
-        payment_url = URLShortener.shorten_url(session.url)
+    @metrics.handler
+    async def report(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Handle the staff-only /report [product|day|location|option] [days] command."""
+        config = settings()
+        if update.effective_user.id not in config.staff_user_ids and str(update.effective_chat.id) != config.staff_channel_id:
+            await update.message.reply_text(text="Unrecognized command. Please try again or check /help for guidance.")
+            return
 
-        quote = f"""
-        \nYour order of {quantity} {product.upper()}(s) totals to €{round(final_price, 2)}.
-        \nYou've chosen {option.upper()} at {location.upper()}.
-        \nPlease click the link below to proceed with the payment:\n\n{payment_url}
-        """
+        name = context.args[0] if context.args else 'product'
+        days = int(context.args[1]) if len(context.args) > 1 and context.args[1].isdigit() else 7
+        if name not in reports.REPORTS:
+            await update.message.reply_text(text=f"Usage: /report [{'|'.join(reports.REPORTS)}] [days]")
+            return
 
-        await update.message.reply_text(text=quote)
-        # await self.send_order_details_to_channel(context)
-        return ConversationHandler.END
+        await update.message.reply_text(text=f"Sales by {name} over the last {days} day(s):")
 
+        # Aggregated on the server and sent back a bounded batch at a time
+        rows = reports.report(database.db, name, days, batch_size=REPORT_BATCH_SIZE)
+        sent = False
+        while True:
+            batch = await repository.run(lambda: list(itertools.islice(rows, REPORT_BATCH_SIZE)))
+            if not batch:
+                break
+            await update.message.reply_text(text=reports.format_rows(name, batch))
+            sent = True
+
+        if not sent:
+            await update.message.reply_text(text="No sales in this period.")
+
+    @metrics.handler
     async def cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        clear_cart(context.user_data)
         await update.message.reply_text(text="Order canceled.")
         return ConversationHandler.END
 
 class OrderNotificationBot:
     def __init__(self):
-        self.bot_token = NOTIFICATION_BOT_KEY
-        self.channel_id = STAFF_CHANNEL_ID
-        self.orders = database.orders
-        self.bot = Bot(token=self.bot_token)
-        # Add a logging statement or print statement to indicate the bot has been initialized
-        logging.info("OrderNotificationBot initialized")
-
-    async def send_notification(self, order: Dict[str, str]) -> None:
-        message = f"New order received:\nProduct: {order['product']}\nQuantity: {order['quantity']}\nOption: {order['option']}\nLocation: {order['location']}\nName: {order['name']}"
-        logging.info(message)
-        await self.bot.send_message(chat_id=STAFF_CHANNEL_ID, text=message)
-        logging.info("Notification sent")
-
-    async def check_for_new_orders(self) -> None:
+        self.bot_token = settings().notification_bot_key
+        self.channel_id = settings().staff_channel_id
+        self.bot = Bot(token=self.bot_token, base_url=settings().telegram_api_url)
+        self.feed = OrderFeed(database.orders, database.db['notifier_state'])
+        self.sender = NotificationSender(self.bot)
+        logger.info("OrderNotificationBot initialized")
+
+    def send_notification(self, order: Dict[str, str], resume_token: Optional[Dict] = None) -> None:
+        message = f"New order received:\nItems: {describe_cart(order['items'])}\nOption: {order['option']}\nLocation: {order['location']}\nName: {order['name']}"
+        logger.debug("Notifying staff of order %s", order['_id'], extra={'order_id': order.get('reservation_id')})
+        # The order only counts as notified once its digest has actually been delivered
+        self.sender.submit(self.channel_id, message, functools.partial(self.feed.acknowledge, order, resume_token))
+
+    async def run(self) -> None:
+        """Send a notification for every new order as soon as it is inserted."""
+        sender_task = asyncio.create_task(self.run_sender())
         try:
-            last_processed_order = await self.orders.find_one(sort=[('_id', pymongo.DESCENDING)])
-        except TypeError:
-            last_processed_order = None
-
-        if last_processed_order is not None:
-            query = {'_id': {'$gt': last_processed_order['_id']}}
-            new_orders_cursor = self.orders.find(query)
-            new_orders = await new_orders_cursor.to_list(length=None)
-
-            for order in new_orders:
-                await self.send_notification(order)
-
-        logging.info("Checking for new orders")
+            async for order, resume_token in self.feed.stream():
+                self.send_notification(order, resume_token)
+        finally:
+            sender_task.cancel()
 
-    def start_scheduled_task(self) -> None:
-        logging.info("Starting scheduled task")
+    async def run_sender(self) -> None:
+        """Keep the sender running; queued notifications survive a crash of its loop."""
         while True:
-            asyncio.run(self.check_for_new_orders())
-            time.sleep(20)  # Wait for 20 seconds
-
-
+            try:
+                await self.sender.run()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Notification sender stopped unexpectedly, restarting")
+                await asyncio.sleep(1)
+
+    def start(self) -> None:
+        logger.info("Starting order notifications")
+        asyncio.run(self.run())
 
 class URLShortener:
-    def shorten_url(url):
-        shortened_url = pyshorteners.Shortener().tinyurl.short(url)
+    @metrics.timed('shortener_seconds', 'Payment link shortening latency')
+    async def shorten_url(url, expires_at=None):
+        # Serve the link ourselves when the redirect endpoint is configured
+        if short_links.enabled:
+            # Stored in MongoDB so whichever process serves /s/ can resolve it
+            return await repository.run(short_links.shorten, url, expires_at)
+        shortened_url = await shorten_external(url)
         return shortened_url
 
 class WebhookHandler(BaseHTTPRequestHandler):
     def __init__(self, *args, **kwargs):
         self.telegram_bot = kwargs.pop('telegram_bot')
+        self.webhook_queue = kwargs.pop('webhook_queue')
+        self.telegram_ingress = kwargs.pop('telegram_ingress', None)
         super().__init__(*args, **kwargs)
     
     def _set_response(self):
@@ -364,48 +597,65 @@ class WebhookHandler(BaseHTTPRequestHandler):
         self.send_header('Content-type', 'application/json')
         self.end_headers()
 
+    def do_GET(self):
+        # Prometheus scrape endpoint
+        if self.path == '/metrics':
+            body = metrics.registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        # Redirect short payment links to their Stripe checkout page
+        if not self.path.startswith(SHORT_LINK_PREFIX):
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        url = short_links.resolve(self.path[len(SHORT_LINK_PREFIX):])
+        if url is None:
+            self.send_response(410)
+            self.end_headers()
+            return
+
+        self.send_response(302)
+        self.send_header('Location', url)
+        self.end_headers()
+
     def do_POST(self):
         content_length = int(self.headers['Content-Length'])
         post_data = self.rfile.read(content_length)
 
-        event_type = self.headers.get('Stripe-Event-Type', None)
+        # Telegram updates in webhook mode share this port with Stripe
+        if self.telegram_ingress is not None and self.path.startswith(TELEGRAM_WEBHOOK_PATH):
+            if not self.telegram_ingress.verify(self.headers.get('X-Telegram-Bot-Api-Secret-Token')):
+                self.send_response(403)
+                self.end_headers()
+                return
+            self.telegram_ingress.dispatch(post_data)
+            self._set_response()
+            return
+
         signature = self.headers.get('Stripe-Signature', None)
-        webhook_secret = 'whsec_3fa56e3e6600c91861d6e4ab6530da03e4b99ee5a9616acd79d1c7f187978123'  # Replace with your webhook secret
 
-        try:
-            event = stripe.Webhook.construct_event(post_data, signature, webhook_secret)
-            self.handle_event(event)
-        except stripe.error.SignatureVerificationError as e:
+        event = verify_event(post_data, signature)
+        if event is None:
             # Invalid signature, handle the error as desired
-            logging.error("Signature verification failed: %s", e)
             self.send_response(400)
             self.end_headers()
             return
 
+        # Redeliveries of events this process already accepted are acknowledged without any I/O
+        if database.ledger.seen(event['id']):
+            self._set_response()
+            return
+
+        # Persist the event and acknowledge; the worker pool does the processing
+        self.webhook_queue.enqueue(event['id'], event['type'], post_data.decode('utf-8'))
         self._set_response()
-        
-    def handle_event(self, event):
-        logging.error('I\'m handling the event')
-        event_type = event['type']
-
-        if event_type == 'checkout.session.completed':
-            checkout_session = event['data']['object']
-            payment_intent_id = checkout_session['payment_intent']
-            
-            # Retrieve the payment_intent object
-            payment_intent = stripe.PaymentIntent.retrieve(payment_intent_id)
-            
-            product = payment_intent['metadata']['product']
-            quantity = int(payment_intent['metadata']['quantity'])
-            option = payment_intent['metadata']['option']
-            location = payment_intent['metadata']['location']
-            name = payment_intent['metadata']['name']
-            
-            # Perform desired actions with product and quantity & more; in this case add the order to the database
-            database.add_order(product, quantity, option, location, name)
 
-        else:
-            logging.error('Unhandled event type: %s', event_type)
 
 def run(server_class, handler_class, port, telegram_bot):
     server_address = ('', port)
@@ -413,32 +663,30 @@ def run(server_class, handler_class, port, telegram_bot):
     print(f'Starting webhook server on port {port}...')
     httpd.serve_forever()
 
-def main() -> None:
+def build_application(shard: Optional[int] = None, shards: Optional[int] = None) -> Application:
+    """Build the order bot, serving the users of one shard (by default the configured one)."""
+    config = settings()
+    if shards is None:
+        shard, shards = config.bot_shard, config.bot_shards
+
     # Create an instance of TelegramBotHandler class
     telegram_bot = TelegramBotHandler()
 
-    # Create an instance of OrderNotificationBot class
-    notification_bot = OrderNotificationBot()
-
-    # Set up the webhook server
-    PORT = 8080  # Specify the desired port
-    server = HTTPServer(('localhost', PORT), lambda *args, **kwargs: WebhookHandler(*args, **kwargs, telegram_bot=telegram_bot))
-    print(f'Starting webhook server on port {PORT}...')
+    # Conversation state survives restarts and is split across bot workers by user id
+    persistence = build_persistence(shard, shards)
 
-    # Start the webhook server in a separate thread
-    server_thread = threading.Thread(target=server.serve_forever)
-    server_thread.start()
+    # Set up the Order Telegram Bot
+    application = Application.builder().token(config.order_bot_key).base_url(config.telegram_api_url).persistence(persistence).build()
 
-    # Start the OrderNotificationBot scheduled task in a separate thread
-    notification_thread = threading.Thread(target=notification_bot.start_scheduled_task)
-    notification_thread.start()
+    # Tag everything logged while handling an update with its user
+    application.add_handler(TypeHandler(Update, logs.bind_update), group=-3)
 
-    # Access all products in order to build CallbackQueryHandler for product selection
-    product_docs = database.products.find({"stock": {"$gt": 0}})
-    products = list(product_docs)
+    # Leave users owned by other bot workers to those workers
+    application.add_handler(TypeHandler(Update, persistence.drop_foreign_updates), group=-2)
 
-    # Set up the Order Telegram Bot
-    application = Application.builder().token(ORDER_BOT_KEY).build()
+    # Abandoned checkouts and idle users' data are expired in the background
+    reaper.attach(application)
+    application.add_handler(TypeHandler(Update, reaper.touch_update), group=-1)
 
     # Define the conversation handler
     conversation_handler = ConversationHandler(
@@ -451,7 +699,8 @@ def main() -> None:
             CommandHandler('cancel', telegram_bot.cancel),
         ],
         PRODUCT: [
-            CallbackQueryHandler(telegram_bot.order_product, pattern="^(" + "|".join(product['name'] for product in products) + ")$"),
+            CallbackQueryHandler(telegram_bot.order_product, pattern=f"^{PRODUCT_CALLBACK_PREFIX}"),
+            CallbackQueryHandler(telegram_bot.show_products_page, pattern=rf"^{PAGE_CALLBACK_PREFIX}\d+$"),
             CommandHandler('start', telegram_bot.start),
             CommandHandler('products', telegram_bot.show_products),
             CommandHandler('help', telegram_bot.help_command),
@@ -464,6 +713,14 @@ def main() -> None:
             CommandHandler('help', telegram_bot.help_command),
             CommandHandler('cancel', telegram_bot.cancel),
         ],
+        CART: [
+            CallbackQueryHandler(telegram_bot.continue_shopping, pattern=f'^{CART_ADD}$'),
+            CallbackQueryHandler(telegram_bot.ask_delivery_option, pattern=f'^{CART_CHECKOUT}$'),
+            CommandHandler('start', telegram_bot.start),
+            CommandHandler('products', telegram_bot.show_products),
+            CommandHandler('help', telegram_bot.help_command),
+            CommandHandler('cancel', telegram_bot.cancel),
+        ],
         OPTION: [
             CallbackQueryHandler(telegram_bot.select_delivery_method, pattern='^(pickup|delivery)$'),
             CommandHandler('start', telegram_bot.start),
@@ -500,14 +757,75 @@ def main() -> None:
             CommandHandler('cancel', telegram_bot.cancel),
         ],
     },
-    fallbacks=[MessageHandler(filters.TEXT, telegram_bot.handle_invalid_input)]
+    fallbacks=[MessageHandler(filters.TEXT, telegram_bot.handle_invalid_input)],
+    name='order_conversation',
+    persistent=True
     )
 
+    # Staff commands take precedence over the order conversation
+    application.add_handler(CommandHandler('report', telegram_bot.report))
+
     # Add the conversation handler to the dispatcher
     application.add_handler(conversation_handler)
+    return application
+
+def main() -> None:
+    # Fail fast on a missing or malformed setting, before anything connects
+    config = settings().require(*REQUIRED)
+    if config.telegram_mode == 'webhook':
+        config.require('telegram_webhook_url')
+        if not urlparse(config.telegram_webhook_url).path.startswith(TELEGRAM_WEBHOOK_PATH):
+            raise ConfigError(f"TELEGRAM_WEBHOOK_URL: path must start with {TELEGRAM_WEBHOOK_PATH}")
+    elif config.bot_shards > 1:
+        # getUpdates hands every update to one poller only, so a polling shard would
+        # silently drop the updates of every user outside its slice
+        raise ConfigError("BOT_SHARDS: sharding needs TELEGRAM_MODE=webhook; a polling worker must serve every user")
+
+    # Create an instance of TelegramBotHandler class
+    telegram_bot = TelegramBotHandler()
+
+    # In webhook mode, updates are fanned out to worker processes keyed by chat id
+    telegram_ingress = None
+    if config.telegram_mode == 'webhook':
+        telegram_ingress = TelegramIngress(build_application)
+        telegram_ingress.start()
+
+    # Create an instance of OrderNotificationBot class
+    notification_bot = OrderNotificationBot()
+
+    # Create missing indexes and apply pending migrations before taking traffic
+    schema.bootstrap(database.db)
+
+    # Process verified Stripe events on a worker pool, off the request path
+    webhook_queue = WebhookQueue(database.db['webhook_events'])
+    webhook_queue.start()
+
+    # Set up the webhook server, one thread per request
+    PORT = config.http_port
+    server = ThreadingHTTPServer(('localhost', PORT), lambda *args, **kwargs: WebhookHandler(*args, **kwargs, telegram_bot=telegram_bot, webhook_queue=webhook_queue, telegram_ingress=telegram_ingress))
+    print(f'Starting webhook server on port {PORT}...')
+
+    # Start the webhook server in a separate thread
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.start()
+
+    # Start the OrderNotificationBot in a separate thread
+    notification_thread = threading.Thread(target=notification_bot.start)
+    notification_thread.start()
+
+    # Keep the product catalog cache in sync with the products collection
+    database.catalog.watch()
+
+    if telegram_ingress is not None:
+        # Tell Telegram where to deliver updates; the workers take it from there
+        bot = Bot(token=config.order_bot_key, base_url=config.telegram_api_url)
+        asyncio.run(bot.set_webhook(url=config.telegram_webhook_url, secret_token=config.telegram_webhook_secret or None))
+        server_thread.join()
+        return
 
     # Start the bot
-    asyncio(application.run_polling())
+    application = build_application()
+    application.run_polling()
 
 if __name__ == '__main__':
     main()
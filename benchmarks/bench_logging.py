@@ -0,0 +1,121 @@
+"""Handler latency with synchronous stderr logging vs. the queued logging pipeline.
+
+Runs many concurrent async "handlers" that each log a few INFO records, the way the
+bot and webhook code do, and reports per-handler latency percentiles for:
+
+  basic     logging.basicConfig-style StreamHandler, written on the calling thread
+  queued    logs.configure_logging() with rate limiting effectively off
+  sampled   logs.configure_logging() with the default per-logger rate limit
+
+`--write-delay` simulates a slow log sink (a pipe to a container runtime, a
+terminal) by sleeping on every write. Fewer writes than records logged means the
+pipeline shed the rest, through the rate limit or a full queue.
+
+    python benchmarks/bench_logging.py --handlers 20000 --records 3 --write-delay 0.0002
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+from typing import (
+    Dict, List, TextIO
+)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logs
+
+
+class SlowStream:
+    """File-like sink that takes `delay` seconds per write, like a congested pipe."""
+
+    def __init__(self, stream: TextIO, delay: float):
+        self.stream = stream
+        self.delay = delay
+        self.writes = 0
+
+    def write(self, data: str) -> int:
+        if self.delay:
+            time.sleep(self.delay)
+        self.writes += 1
+        return self.stream.write(data)
+
+    def flush(self) -> None:
+        self.stream.flush()
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def configure(mode: str, sink: SlowStream) -> None:
+    if mode == 'basic':
+        root = logging.getLogger()
+        logs.shutdown()
+        for existing in list(root.handlers):
+            root.removeHandler(existing)
+        handler = logging.StreamHandler(sink)
+        handler.setFormatter(logging.Formatter(logs.TEXT_FORMAT))
+        root.addHandler(handler)
+        root.setLevel(logging.INFO)
+    elif mode == 'queued':
+        logs.configure_logging(level='INFO', stream=sink, rate=1e12, burst=1e12, rates={})
+    else:
+        logs.configure_logging(level='INFO', stream=sink, rates={})
+
+
+async def run(handlers: int, concurrency: int, records: int) -> List[float]:
+    logger = logging.getLogger('bench.handler')
+    latencies: List[float] = []
+    limit = asyncio.Semaphore(concurrency)
+
+    async def handle(user_id: int) -> None:
+        async with limit:
+            started = time.perf_counter()
+            with logs.bind(user_id=user_id, order_id=f'r{user_id}'):
+                for step in range(records):
+                    logger.info("Handled step %d for user %d with cart %s", step, user_id, {'product': 'bench', 'quantity': step})
+                    await asyncio.sleep(0)
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(handle(user) for user in range(handlers)))
+    return latencies
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--handlers', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--records', type=int, default=3, help='records logged per handler')
+    parser.add_argument('--write-delay', type=float, default=0.0001, help='seconds spent per write to the sink')
+    parser.add_argument('--modes', default='basic,queued,sampled')
+    args = parser.parse_args()
+
+    results: Dict[str, Dict[str, float]] = {}
+    for mode in args.modes.split(','):
+        with tempfile.TemporaryFile('w') as file:
+            sink = SlowStream(file, args.write_delay)
+            configure(mode, sink)
+            started = time.perf_counter()
+            latencies = asyncio.run(run(args.handlers, args.concurrency, args.records))
+            elapsed = time.perf_counter() - started
+            logs.shutdown()
+            results[mode] = {
+                'p50': percentile(latencies, 0.5) * 1000,
+                'p99': percentile(latencies, 0.99) * 1000,
+                'throughput': args.handlers / elapsed,
+                'written': sink.writes,
+            }
+
+    print(f"{args.handlers} handlers x {args.records} records, concurrency {args.concurrency}, write delay {args.write_delay * 1e6:.0f}us")
+    print(f"{'mode':<10} {'p50 ms':>9} {'p99 ms':>9} {'handlers/s':>12} {'writes':>9}")
+    for mode, result in results.items():
+        print(f"{mode:<10} {result['p50']:9.2f} {result['p99']:9.2f} {result['throughput']:12,.0f} {result['written']:9,}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+"""End-to-end, offline capacity benchmark of the ordering flow.
+
+Drives simulated users through the whole conversation (/start, /products, pick a
+product, quantity, checkout, pickup point, name, CONFIRM) against local stand-ins:
+mongomock or a local mongod, a fake Stripe that pays every session and delivers a
+signed checkout.session.completed webhook, and a fake Telegram Bot API. Reports
+orders per second, per-step latency percentiles, stock correctness and staff
+notification lag.
+
+    python benchmarks/bench_order_flow.py --users 2000 --concurrency 200
+    python benchmarks/bench_order_flow.py --mongo mongodb://localhost:27017 --users 5000
+"""
+import os
+import sys
+import time
+import socket
+import asyncio
+import argparse
+import itertools
+import threading
+from collections import (
+    defaultdict
+)
+from typing import (
+    Callable, Dict, List, Tuple
+)
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_telegram import (
+    FakeServer,
+    FakeTelegramAPI
+)
+from fake_stripe import (
+    FakeStripe
+)
+
+BOT_TOKEN = '123456:benchmark'
+STAFF_CHANNEL_ID = '-1001'
+WEBHOOK_SECRET = 'whsec_benchmark'
+PRODUCT = {"id": "1", "name": "Bench", "price": 2.5}
+
+update_ids = itertools.count(1)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def standalone_watch(*args, **kwargs):
+    from pymongo.errors import (
+        OperationFailure
+    )
+    raise OperationFailure("The $changeStream stage is only supported on replica sets", code=40573)
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def message(user_id: int, text: str) -> Dict:
+    update = {
+        "update_id": next(update_ids),
+        "message": {
+            "message_id": next(update_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+            "text": text,
+        },
+    }
+    if text.startswith('/'):
+        update["message"]["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return update
+
+
+def callback(user_id: int, data: str) -> Dict:
+    return {
+        "update_id": next(update_ids),
+        "callback_query": {
+            "id": str(next(update_ids)),
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": next(update_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "",
+            },
+        },
+    }
+
+
+# (step name, update factory) for one complete order of `quantity` units
+def order_steps(quantity: int) -> List[Tuple[str, Callable[[int], Dict]]]:
+    return [
+        ('start', lambda user: message(user, '/start')),
+        ('products', lambda user: message(user, '/products')),
+        ('product', lambda user: callback(user, f"product:{PRODUCT['id']}")),
+        ('quantity', lambda user: message(user, str(quantity))),
+        ('checkout', lambda user: callback(user, 'cart:checkout')),
+        ('option', lambda user: callback(user, 'pickup')),
+        ('pickup', lambda user: callback(user, 'estoril')),
+        ('name', lambda user: message(user, 'Bench User')),
+        ('confirm', lambda user: message(user, 'CONFIRM')),
+    ]
+
+
+async def drive(app, users: int, concurrency: int, quantity: int) -> Dict[str, List[float]]:
+    from telegram import (
+        Update
+    )
+
+    application = app.build_application()
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    limit = asyncio.Semaphore(concurrency)
+    steps = order_steps(quantity)
+
+    async def simulate(user_id: int) -> None:
+        async with limit:
+            for step, build in steps:
+                update = Update.de_json(build(user_id), application.bot)
+                started = time.perf_counter()
+                await application.process_update(update)
+                latencies[step].append(time.perf_counter() - started)
+
+    async with application:
+        await asyncio.gather(*(simulate(100_000 + user) for user in range(users)))
+    return latencies
+
+
+def wait_until(condition: Callable[[], bool], timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return condition()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--quantity', type=int, default=1)
+    parser.add_argument('--stock', type=int, default=None, help='initial stock (default: enough for every user)')
+    parser.add_argument('--mongo', default='mongomock', help="'mongomock' or a MongoDB URI")
+    parser.add_argument('--timeout', type=float, default=120)
+    args = parser.parse_args()
+    stock = args.stock if args.stock is not None else args.users * args.quantity
+
+    telegram_api = FakeTelegramAPI().start()
+    port = free_port()
+    fake_stripe = FakeStripe(f'http://localhost:{port}/', WEBHOOK_SECRET).start()
+
+    # Everything below is read by the bot modules at import time or first use
+    os.environ.update({
+        'ORDER_BOT_KEY': BOT_TOKEN,
+        'NOTIFICATION_BOT_KEY': BOT_TOKEN,
+        'STAFF_CHANNEL_ID': STAFF_CHANNEL_ID,
+        'STRIPE_API_KEY': 'sk_test_benchmark',
+        'STRIPE_API_BASE': fake_stripe.base_url,
+        'STRIPE_WEBHOOK_SECRET': WEBHOOK_SECRET,
+        'MONGO_DATABASE': 'order_bot_bench',
+        'TELEGRAM_API_URL': telegram_api.base_url,
+        'STATE_BACKEND': 'local',
+        'STATE_PATH': ':memory:',
+        'LOG_LEVEL': 'WARNING',
+        'SHORT_LINK_BASE_URL': f'http://localhost:{port}',
+    })
+    if args.mongo == 'mongomock':
+        import mongomock
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+        # Behave like a standalone mongod: no change streams, so the catalog and
+        # notifier take their polling/listener fallbacks
+        mongomock.Collection.watch = standalone_watch
+    else:
+        os.environ['MONGO_URI'] = args.mongo
+
+    import app
+    import schema
+    import database
+    import webhooks
+    from webhooks import (
+        WebhookQueue
+    )
+
+    # Fresh catalog and order history
+    for collection in ('products', 'orders', 'reservations', 'processed_events', 'webhook_events', 'notifier_state'):
+        database.db.drop_collection(collection)
+    if args.mongo != 'mongomock':
+        schema.bootstrap(database.db)
+    database.products.insert_one({**PRODUCT, "stock": stock})
+    database.catalog.invalidate()
+
+    webhook_queue = WebhookQueue(database.db['webhook_events'])
+    webhook_queue.start()
+    class QuietWebhookHandler(app.WebhookHandler):
+        def log_message(self, format, *args):
+            pass
+
+    server = FakeServer(('localhost', port), lambda *a, **kw: QuietWebhookHandler(*a, **kw, telegram_bot=None, webhook_queue=webhook_queue))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    notification_bot = app.OrderNotificationBot()
+    threading.Thread(target=notification_bot.start, daemon=True).start()
+
+    started = time.perf_counter()
+    latencies = asyncio.run(drive(app, args.users, args.concurrency, args.quantity))
+    conversations_done = time.perf_counter()
+
+    expected_orders = min(args.users, stock // args.quantity)
+    orders_done = wait_until(lambda: database.orders.count_documents({}) >= expected_orders, args.timeout)
+    orders_elapsed = time.perf_counter() - started
+    lag = notification_bot.feed.lag
+    notified = wait_until(lambda: lag.count >= expected_orders, args.timeout)
+
+    orders = database.orders.count_documents({})
+    final_stock = database.products.find_one({"id": PRODUCT['id']})['stock']
+    sold = sum(item['quantity'] for order in database.orders.find({}, {"items": 1}) for item in order['items'])
+
+    print(f"users:              {args.users} (concurrency {args.concurrency})")
+    print(f"conversations:      {conversations_done - started:.2f}s")
+    print(f"orders:             {orders}/{expected_orders} ({'complete' if orders_done else 'timed out'})")
+    print(f"throughput:         {orders / orders_elapsed:,.1f} orders/s")
+    print("step latency (ms):  p50 / p99")
+    for step, _ in order_steps(args.quantity):
+        print(f"  {step:<16} {percentile(latencies[step], 0.5) * 1000:8.1f} / {percentile(latencies[step], 0.99) * 1000:8.1f}")
+    stock_ok = final_stock >= 0 and final_stock == stock - sold
+    print(f"stock:              {stock} -> {final_stock}, {sold} sold ({'consistent' if stock_ok else 'INCONSISTENT'})")
+    print(f"notification lag:   p50 <={lag.percentile(0.5):.3f}s / p99 <={lag.percentile(0.99):.3f}s ({lag.count} notified, {'all' if notified else 'incomplete'})")
+    print(f"stripe per order:   {len(fake_stripe.sessions) / max(orders, 1):.2f} sessions, {webhooks.api_calls_per_order():.2f} webhook API calls")
+
+    server.shutdown()
+    fake_stripe.stop()
+    telegram_api.stop()
+    sys.exit(0 if orders_done and stock_ok and notified else 1)
+
+
+if __name__ == '__main__':
+    main()
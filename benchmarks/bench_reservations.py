@@ -0,0 +1,87 @@
+"""Contention benchmark for StockReservations.
+
+Many threads race to reserve the same product against a real MongoDB and the run
+checks that the amount handed out never exceeds the starting stock.
+
+    python benchmarks/bench_reservations.py --mongo-uri mongodb://localhost:27017 --threads 64 --orders 20000
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+import pymongo
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reservations import (
+    StockReservations
+)
+
+
+def run(mongo_uri: str, threads: int, orders: int, stock: int, quantity: int) -> bool:
+    client = pymongo.MongoClient(mongo_uri, maxPoolSize=threads)
+    db = client['order_bot_bench']
+    db.drop_collection('products')
+    db.drop_collection('reservations')
+    db['products'].insert_one({"id": "1", "name": "bench", "price": 1, "stock": stock})
+
+    reservations = StockReservations(db['products'], db['reservations'])
+    reserved = []
+    rejected = [0]
+    lock = threading.Lock()
+    per_thread = orders // threads
+
+    def worker() -> None:
+        for _ in range(per_thread):
+            reservation_id = reservations.reserve([{"product": "bench", "quantity": quantity}])
+            with lock:
+                if reservation_id is None:
+                    rejected[0] += 1
+                else:
+                    reserved.append(reservation_id)
+
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    # Commit half of the holds and release the rest, then check the books balance
+    for index, reservation_id in enumerate(reserved):
+        if index % 2:
+            reservations.release(reservation_id)
+        else:
+            reservations.commit(reservation_id)
+
+    final_stock = db['products'].find_one({"name": "bench"})['stock']
+    sold = ((len(reserved) + 1) // 2) * quantity
+    oversold = len(reserved) * quantity - stock
+
+    print(f"attempts:      {per_thread * threads} from {threads} threads")
+    print(f"throughput:    {per_thread * threads / elapsed:,.0f} reservations/s")
+    print(f"reserved:      {len(reserved)}  rejected: {rejected[0]}")
+    print(f"oversold:      {max(oversold, 0)} units")
+    print(f"final stock:   {final_stock} (expected {stock - sold})")
+
+    client.drop_database('order_bot_bench')
+    return oversold <= 0 and final_stock == stock - sold
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mongo-uri', default='mongodb://localhost:27017')
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--orders', type=int, default=10000)
+    parser.add_argument('--stock', type=int, default=1000)
+    parser.add_argument('--quantity', type=int, default=1)
+    args = parser.parse_args()
+
+    ok = run(args.mongo_uri, args.threads, args.orders, args.stock, args.quantity)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
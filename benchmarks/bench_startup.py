@@ -0,0 +1,110 @@
+"""Cold-start time of an order bot worker.
+
+Starts fresh interpreters, each of which imports `app`, builds the application and
+answers a first /start update against the fake Telegram API, and reports the median
+time to each milestone. Also lists which heavy dependencies were imported and
+whether MongoDB was connected by then, to catch regressions in lazy loading.
+
+    python benchmarks/bench_startup.py --runs 10
+    python benchmarks/bench_startup.py --mongo mongodb://localhost:27017
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+from typing import (
+    Dict, List
+)
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_telegram import (
+    FakeTelegramAPI
+)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('stripe', 'requests', 'pyshorteners', 'pymongo', 'telegram')
+
+WORKER = '''
+import sys, time, json, asyncio
+started = time.perf_counter()
+sys.path.insert(0, {root!r})
+if {mongomock!r}:
+    import mongomock, pymongo
+    pymongo.MongoClient = mongomock.MongoClient
+imported_at = time.perf_counter()
+import app
+import database
+from telegram import Update
+imported = time.perf_counter()
+application = app.build_application()
+built = time.perf_counter()
+update = {{
+    "update_id": 1,
+    "message": {{
+        "message_id": 1, "date": 0, "text": "/start",
+        "chat": {{"id": 42, "type": "private"}},
+        "from": {{"id": 42, "is_bot": False, "first_name": "Bench"}},
+        "entities": [{{"type": "bot_command", "offset": 0, "length": 6}}],
+    }},
+}}
+
+async def first_reply():
+    async with application:
+        await application.process_update(Update.de_json(update, application.bot))
+
+asyncio.run(first_reply())
+replied = time.perf_counter()
+print(json.dumps({{
+    "import": imported - imported_at,
+    "build": built - imported,
+    "first_reply": replied - built,
+    "total": replied - started,
+    "loaded": [name for name in {heavy!r} if name in sys.modules],
+    "mongo_connected": database._client is not None,
+}}))
+'''
+
+
+def run_worker(env: Dict[str, str], mongomock: bool) -> Dict:
+    code = WORKER.format(root=ROOT, mongomock=mongomock, heavy=HEAVY_MODULES)
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result['process'] = time.perf_counter() - started
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--mongo', default='mongomock', help="'mongomock' or a MongoDB URI")
+    args = parser.parse_args()
+
+    api = FakeTelegramAPI().start()
+    env = dict(
+        os.environ,
+        TELEGRAM_API_URL=api.base_url,
+        ORDER_BOT_KEY='123456:benchmark',
+        STATE_BACKEND='local',
+        STATE_PATH=':memory:',
+        LOG_LEVEL='WARNING',
+    )
+    if args.mongo != 'mongomock':
+        env['MONGO_URI'] = args.mongo
+
+    results: List[Dict] = [run_worker(env, args.mongo == 'mongomock') for _ in range(args.runs)]
+    api.stop()
+
+    print(f"{args.runs} cold starts, median seconds")
+    for step in ('import', 'build', 'first_reply', 'total', 'process'):
+        print(f"  {step:<12} {statistics.median(result[step] for result in results):.3f}")
+    print(f"  imported:    {', '.join(results[-1]['loaded'])}")
+    print(f"  mongo connected before first reply: {results[-1]['mongo_connected']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Throughput of the Telegram webhook ingress and its worker processes, offline.
+
+Starts a fake Bot API, fans synthetic /start and /help updates for many chats out
+to the order bot workers, and reports updates per second and whether every chat
+saw its replies in order.
+
+    TELEGRAM_MODE=webhook python benchmarks/bench_telegram_webhook.py --workers 4 --chats 500
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_telegram import (
+    FakeTelegramAPI
+)
+
+
+def message_update(update_id: int, chat_id: int, text: str) -> dict:
+    update = {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"User{chat_id}"},
+            "text": text,
+        },
+    }
+    if text.startswith('/'):
+        update["message"]["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return update
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--chats', type=int, default=200)
+    args = parser.parse_args()
+
+    api = FakeTelegramAPI().start()
+    # The bot reads its endpoint at import time
+    os.environ['TELEGRAM_API_URL'] = api.base_url
+    os.environ['STATE_BACKEND'] = 'local'
+    os.environ['STATE_PATH'] = ':memory:'
+    os.environ['ORDER_BOT_KEY'] = '123456:benchmark'
+
+    import app
+    from telegram_ingress import (
+        TelegramIngress
+    )
+
+    ingress = TelegramIngress(app.build_application, workers=args.workers, secret_token='')
+    ingress.start()
+
+    updates = []
+    for chat in range(args.chats):
+        chat_id = 10_000 + chat
+        updates.append(message_update(2 * chat, chat_id, '/start'))
+        updates.append(message_update(2 * chat + 1, chat_id, '/help'))
+
+    started = time.perf_counter()
+    for update in updates:
+        ingress.dispatch(json.dumps(update).encode())
+    completed = api.wait_for('sendMessage', len(updates))
+    elapsed = time.perf_counter() - started
+    ingress.stop()
+    api.stop()
+
+    in_order = all(
+        len(texts) == 2 and texts[0].startswith('Hello') and 'available commands' in texts[1]
+        for texts in api.messages.values()
+    )
+    print(f"workers:     {args.workers}")
+    print(f"updates:     {len(updates)} from {args.chats} chats")
+    print(f"completed:   {completed}")
+    print(f"throughput:  {len(updates) / elapsed:,.0f} updates/s")
+    print(f"in order:    {in_order}")
+    sys.exit(0 if completed and in_order else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""A local stand-in for the Stripe API, for offline benchmarks.
+
+Creates checkout sessions and, as if every customer paid straight away, delivers a
+signed checkout.session.completed webhook for each one after a short delay.
+"""
+import re
+import json
+import time
+import uuid
+import threading
+import http.client
+from concurrent.futures import (
+    ThreadPoolExecutor
+)
+from http.server import (
+    BaseHTTPRequestHandler
+)
+from typing import (
+    Dict, List
+)
+from urllib.parse import (
+    parse_qs,
+    urlparse
+)
+
+from replay_webhooks import (
+    sign
+)
+from fake_telegram import (
+    FakeServer
+)
+
+METADATA_KEY = re.compile(r'^metadata\[(\w+)\]$')
+LINE_ITEM_KEY = re.compile(r'^line_items\[(\d+)\]\[(quantity|price_data\]\[unit_amount)\]$')
+
+
+class FakeStripe:
+    """Threaded HTTP server implementing checkout session creation."""
+
+    def __init__(self, webhook_url: str, webhook_secret: str, payment_delay: float = 0.05, host: str = 'localhost', port: int = 0):
+        self.webhook_url = urlparse(webhook_url)
+        self.webhook_secret = webhook_secret
+        self.payment_delay = payment_delay
+        self.sessions: Dict[str, Dict] = {}
+        self.delivered: List[float] = []
+        self.lock = threading.Lock()
+        self.webhooks = ThreadPoolExecutor(max_workers=16, thread_name_prefix='fake-stripe-webhook')
+        stripe = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode()
+                idempotency_key = self.headers.get('Idempotency-Key')
+                if self.path.startswith('/v1/checkout/sessions'):
+                    result = stripe.create_session(parse_qs(body), idempotency_key)
+                else:
+                    result = {"id": uuid.uuid4().hex, "object": "unknown"}
+                payload = json.dumps(result).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        self.server = FakeServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'FakeStripe':
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.webhooks.shutdown(wait=True)
+
+    def create_session(self, form: Dict[str, List[str]], idempotency_key: str) -> Dict:
+        with self.lock:
+            if idempotency_key in self.sessions:
+                return self.sessions[idempotency_key]
+
+        metadata = {}
+        lines: Dict[str, Dict[str, int]] = {}
+        for key, values in form.items():
+            match = METADATA_KEY.match(key)
+            if match:
+                metadata[match.group(1)] = values[0]
+            match = LINE_ITEM_KEY.match(key)
+            if match:
+                lines.setdefault(match.group(1), {})[match.group(2)] = int(values[0])
+
+        session_id = f"cs_test_{uuid.uuid4().hex}"
+        session = {
+            "id": session_id,
+            "object": "checkout.session",
+            "url": f"{self.base_url}/pay/{session_id}",
+            "expires_at": int(form.get('expires_at', [time.time() + 1800])[0]),
+            "client_reference_id": form.get('client_reference_id', [None])[0],
+            "payment_intent": f"pi_{uuid.uuid4().hex}",
+            "amount_total": sum(line.get('price_data][unit_amount', 0) * line.get('quantity', 1) for line in lines.values()),
+            "metadata": metadata,
+        }
+        with self.lock:
+            self.sessions[idempotency_key] = session
+
+        self.webhooks.submit(self._pay, session)
+        return session
+
+    def _pay(self, session: Dict) -> None:
+        time.sleep(self.payment_delay)
+        event = {
+            "id": f"evt_{uuid.uuid4().hex}",
+            "object": "event",
+            "type": "checkout.session.completed",
+            "created": int(time.time()),
+            "data": {"object": session},
+        }
+        payload = json.dumps(event)
+        connection = http.client.HTTPConnection(self.webhook_url.hostname, self.webhook_url.port, timeout=30)
+        connection.request('POST', self.webhook_url.path or '/', body=payload, headers={
+            'Content-Type': 'application/json',
+            'Stripe-Signature': sign(payload, self.webhook_secret, int(time.time())),
+        })
+        connection.getresponse().read()
+        connection.close()
+        with self.lock:
+            self.delivered.append(time.monotonic())
@@ -0,0 +1,114 @@
+"""A local stand-in for the Telegram Bot API, for offline benchmarks.
+
+Answers the methods the bots call with plausible results and records every call,
+so a benchmark can wait for replies and check their order per chat.
+"""
+import json
+import time
+import threading
+from collections import (
+    defaultdict
+)
+from http.server import (
+    BaseHTTPRequestHandler,
+    ThreadingHTTPServer
+)
+from typing import (
+    Dict, List
+)
+from urllib.parse import (
+    parse_qs
+)
+
+class FakeServer(ThreadingHTTPServer):
+    """Threaded server with a listen backlog deep enough for benchmark bursts."""
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Order Bot", "username": "order_bot"}
+
+
+class FakeTelegramAPI:
+    """Threaded HTTP server implementing just enough of the Bot API."""
+
+    def __init__(self, host: str = 'localhost', port: int = 0):
+        self.calls: Dict[str, int] = defaultdict(int)
+        self.messages: Dict[int, List[str]] = defaultdict(list)
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.message_id = 0
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                method = self.path.rsplit('/', 1)[-1]
+                result = api.handle(method, api.parse(self.headers.get('Content-Type', ''), body))
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST
+
+        self.server = FakeServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/bot'
+
+    def start(self) -> 'FakeTelegramAPI':
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+
+    @staticmethod
+    def parse(content_type: str, body: bytes) -> Dict:
+        if not body:
+            return {}
+        if content_type.startswith('application/json'):
+            return json.loads(body)
+        return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+    def handle(self, method: str, params: Dict):
+        with self.condition:
+            self.calls[method] += 1
+            self.message_id += 1
+            message_id = self.message_id
+            if method in ('sendMessage', 'editMessageText'):
+                self.messages[int(params.get('chat_id', 0))].append(params.get('text', ''))
+            self.condition.notify_all()
+
+        if method == 'getMe':
+            return BOT_USER
+        if method in ('sendMessage', 'editMessageText'):
+            chat_id = int(params.get('chat_id', 0))
+            return {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": params.get('text', ''),
+            }
+        return True
+
+    def wait_for(self, method: str, count: int, timeout: float = 60) -> bool:
+        """Block until `method` has been called `count` times."""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.calls[method] < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
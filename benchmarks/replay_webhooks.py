@@ -0,0 +1,126 @@
+"""Replay signed Stripe webhook events against the webhook server at a fixed rate.
+
+Measures how quickly the ingress acknowledges events, which is what Stripe's
+delivery timeouts care about.
+
+    python benchmarks/replay_webhooks.py --url http://localhost:8080/ --secret whsec_... --rate 200 --duration 30
+"""
+import hmac
+import json
+import time
+import uuid
+import hashlib
+import argparse
+import threading
+import http.client
+from urllib.parse import (
+    urlparse
+)
+from typing import (
+    Dict, List
+)
+
+
+def sample_event(event_type: str = 'checkout.session.completed') -> Dict:
+    """A minimal checkout.session.completed event carrying the order metadata."""
+    return {
+        "id": f"evt_{uuid.uuid4().hex}",
+        "object": "event",
+        "type": event_type,
+        "created": int(time.time()),
+        "data": {
+            "object": {
+                "id": f"cs_test_{uuid.uuid4().hex}",
+                "object": "checkout.session",
+                "payment_intent": f"pi_{uuid.uuid4().hex}",
+                "client_reference_id": uuid.uuid4().hex,
+                "metadata": {
+                    "product": "bench",
+                    "quantity": "1",
+                    "option": "pickup",
+                    "location": "estoril",
+                    "name": "Load Test",
+                },
+            },
+        },
+    }
+
+
+def sign(payload: str, secret: str, timestamp: int) -> str:
+    """Build a Stripe-Signature header the way Stripe does."""
+    signature = hmac.new(secret.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def replay(url: str, secret: str, rate: float, duration: float, connections: int) -> None:
+    target = urlparse(url)
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    lock = threading.Lock()
+    interval = connections / rate
+    deadline = time.monotonic() + duration
+
+    def sender() -> None:
+        connection = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=30)
+        next_send = time.monotonic()
+        while next_send < deadline:
+            payload = json.dumps(sample_event())
+            headers = {
+                'Content-Type': 'application/json',
+                'Stripe-Signature': sign(payload, secret, int(time.time())),
+            }
+            started = time.perf_counter()
+            try:
+                connection.request('POST', target.path or '/', body=payload, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=30)
+                status = 0
+            elapsed = time.perf_counter() - started
+
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+
+            next_send += interval
+            time.sleep(max(0.0, next_send - time.monotonic()))
+
+    threads = [threading.Thread(target=sender) for _ in range(connections)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    print(f"sent:       {len(latencies)} events in {elapsed:.1f}s ({len(latencies) / elapsed:,.0f}/s)")
+    print(f"statuses:   {statuses}")
+    print(f"ack p50:    {percentile(latencies, 0.50) * 1000:.1f} ms")
+    print(f"ack p99:    {percentile(latencies, 0.99) * 1000:.1f} ms")
+    print(f"ack max:    {max(latencies, default=0) * 1000:.1f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:8080/')
+    parser.add_argument('--secret', required=True, help='webhook signing secret configured on the server')
+    parser.add_argument('--rate', type=float, default=100, help='events per second')
+    parser.add_argument('--duration', type=float, default=10, help='seconds')
+    parser.add_argument('--connections', type=int, default=16)
+    args = parser.parse_args()
+
+    replay(args.url, args.secret, args.rate, args.duration, args.connections)
+
+
+if __name__ == '__main__':
+    main()
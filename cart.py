@@ -0,0 +1,55 @@
+import json
+from typing import (
+    Dict, List, Optional
+)
+
+# Stripe rejects metadata values longer than this
+MAX_METADATA_LENGTH = 500
+
+
+def get_cart(user_data: Dict) -> List[Dict]:
+    """The user's cart: a list of `{product, quantity}` lines kept in user_data."""
+    return user_data.setdefault('cart', [])
+
+
+def quantity_in_cart(user_data: Dict, product: str) -> int:
+    return sum(item['quantity'] for item in get_cart(user_data) if item['product'] == product)
+
+
+def add_item(user_data: Dict, product: str, quantity: int) -> None:
+    """Add `quantity` of `product`, merging with an existing line for the same product."""
+    cart = get_cart(user_data)
+    for item in cart:
+        if item['product'] == product:
+            item['quantity'] += quantity
+            return
+    cart.append({'product': product, 'quantity': quantity})
+
+
+def clear_cart(user_data: Dict) -> None:
+    user_data.pop('cart', None)
+
+
+def describe_cart(cart: List[Dict]) -> str:
+    return ", ".join(f"{item['quantity']} x {item['product']}" for item in cart)
+
+
+def encode_items(cart: List[Dict]) -> Optional[str]:
+    """Compact form of the cart, with each line's charged unit amount, for Stripe metadata.
+
+    Returns None if it would not fit.
+    """
+    lines = [[item['product'], item['quantity']] + ([item['unit_amount']] if 'unit_amount' in item else []) for item in cart]
+    encoded = json.dumps(lines, separators=(',', ':'))
+    return encoded if len(encoded) <= MAX_METADATA_LENGTH else None
+
+
+def decode_items(encoded: str) -> List[Dict]:
+    items = []
+    for line in json.loads(encoded):
+        item = {'product': line[0], 'quantity': int(line[1])}
+        # Sessions created before the charged price was recorded carry only two fields
+        if len(line) > 2:
+            item['unit_amount'] = int(line[2])
+        items.append(item)
+    return items
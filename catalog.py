@@ -0,0 +1,164 @@
+import time
+import logging
+import itertools
+import threading
+from typing import (
+    Dict, List, Optional, NamedTuple
+)
+from pymongo.errors import (
+    PyMongoError
+)
+
+logger = logging.getLogger(__name__)
+
+
+def product_id(product: Dict) -> str:
+    """The short id used to refer to a product in callback data."""
+    return str(product.get('id') or product['_id'])
+
+
+class CatalogSnapshot(NamedTuple):
+    """Immutable view of the product catalog at a given version."""
+    version: int
+    loaded_at: float
+    products: Dict[str, Dict]
+    by_id: Dict[str, Dict]
+    available: List[Dict]
+
+    @classmethod
+    def build(cls, version: int, loaded_at: float, products: List[Dict]) -> 'CatalogSnapshot':
+        products = sorted(products, key=lambda product: product['name'])
+        return cls(
+            version=version,
+            loaded_at=loaded_at,
+            products={product['name']: product for product in products},
+            by_id={product_id(product): product for product in products},
+            available=[product for product in products if product.get('stock', 0) > 0],
+        )
+
+
+class ProductCatalog:
+    """Process-local cache of the products collection.
+
+    Handlers read names, prices and stock from the current snapshot. The snapshot is
+    reloaded when it is older than `ttl` seconds or after an explicit `invalidate()`,
+    which the database layer calls after every stock write. While a change stream is
+    being watched, changes are applied to the snapshot one product at a time instead
+    and local invalidations are left to the stream. Stock read from here is only
+    advisory; the authoritative check happens when stock is reserved.
+
+    Every invalidation bumps a generation counter. A reload only marks the snapshot
+    fresh if no invalidation arrived while its query was running, and readers that
+    queue up behind a reload reuse its result instead of querying again.
+    """
+
+    def __init__(self, collection, ttl: float = 30.0):
+        self.collection = collection
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._snapshot = CatalogSnapshot.build(version=0, loaded_at=0.0, products=[])
+        self._stale = True
+        self._generations = itertools.count(1)
+        self._generation = 0
+        self._loaded_generation = -1
+        self._watching = False
+        self._watch_thread = None
+
+    def is_fresh(self) -> bool:
+        """Whether the current snapshot can be served without touching the database."""
+        if self._stale:
+            return False
+        return self._watching or time.monotonic() - self._snapshot.loaded_at <= self.ttl
+
+    def snapshot(self) -> CatalogSnapshot:
+        """Return the current snapshot, reloading it first if it is stale or expired."""
+        if not self.is_fresh():
+            return self.refresh()
+        return self._snapshot
+
+    def refresh(self) -> CatalogSnapshot:
+        """Reload every product from the database and publish a new snapshot."""
+        requested = self._generation
+        with self._lock:
+            # Another thread reloaded while this one waited for the lock
+            if self._loaded_generation >= requested and self.is_fresh():
+                return self._snapshot
+
+            generation = self._generation
+            self._snapshot = CatalogSnapshot.build(
+                version=self._snapshot.version + 1,
+                loaded_at=time.monotonic(),
+                products=list(self.collection.find({})),
+            )
+            self._loaded_generation = generation
+            # A write invalidated the catalog mid-query; the next read reloads again
+            self._stale = self._generation != generation
+            return self._snapshot
+
+    def invalidate(self) -> None:
+        """Mark the snapshot as stale so the next read reloads it."""
+        if not self._watching:
+            self._mark_stale()
+
+    def _mark_stale(self) -> None:
+        self._generation = next(self._generations)
+        self._stale = True
+
+    def apply_change(self, change: Dict) -> None:
+        """Fold one change stream event into the snapshot without reloading the rest."""
+        operation = change['operationType']
+        if operation in ('insert', 'update', 'replace') and change.get('fullDocument'):
+            changed = change['fullDocument']
+        elif operation == 'delete':
+            changed = None
+        else:
+            self._mark_stale()
+            return
+
+        with self._lock:
+            document_id = change['documentKey']['_id']
+            products = [product for product in self._snapshot.products.values() if product['_id'] != document_id]
+            if changed is not None:
+                products.append(changed)
+            self._snapshot = CatalogSnapshot.build(
+                version=self._snapshot.version + 1,
+                loaded_at=self._snapshot.loaded_at,
+                products=products,
+            )
+
+    def get(self, name: str) -> Optional[Dict]:
+        return self.snapshot().products.get(name)
+
+    def get_by_id(self, id: str) -> Optional[Dict]:
+        return self.snapshot().by_id.get(id)
+
+    def available(self) -> List[Dict]:
+        """Return the products that currently have stock, sorted by name."""
+        return self.snapshot().available
+
+    def watch(self) -> None:
+        """Keep the snapshot in step with the products collection through a change stream.
+
+        Change streams need a replica set; on a standalone server this logs and
+        returns, leaving TTL expiry and explicit invalidation in charge.
+        """
+        if self._watch_thread is not None:
+            return
+        self._watch_thread = threading.Thread(target=self._watch_loop, daemon=True)
+        self._watch_thread.start()
+
+    def _watch_loop(self) -> None:
+        try:
+            with self.collection.watch(full_document='updateLookup') as stream:
+                # Anything written before the stream opened is picked up by a full reload
+                self._mark_stale()
+                self.refresh()
+                self._watching = True
+                for change in stream:
+                    self.apply_change(change)
+        except PyMongoError as e:
+            logger.warning("Product change stream unavailable, falling back to TTL refresh: %s", e)
+        finally:
+            self._watching = False
+            self._mark_stale()
+            self._watch_thread = None
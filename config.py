@@ -0,0 +1,181 @@
+import os
+import re
+import json
+import functools
+from typing import (
+    Any, Dict, Mapping, NamedTuple, Tuple
+)
+
+# Optional JSON file holding any of the settings below, keyed by field name;
+# environment variables (the field name in upper case) take precedence over it
+CONFIG_PATH = os.environ.get('ORDER_BOT_CONFIG', '')
+
+BOT_TOKEN_PATTERN = re.compile(r'^\d+:[\w-]+$')
+
+# Accepted spellings of boolean settings in the environment
+BOOLEANS = {'1': True, 'true': True, 'yes': True, 'on': True, '0': False, 'false': False, 'no': False, 'off': False}
+
+
+class ConfigError(ValueError):
+    """The configuration is missing a required setting or holds a malformed one."""
+
+
+class Config(NamedTuple):
+    """Deployment settings and secrets, loaded and validated once per process."""
+    # Order bot and notification bot tokens from @BotFather
+    order_bot_key: str = ''
+    notification_bot_key: str = ''
+    # Staff chat that receives order notifications, and users allowed staff commands such as /report
+    staff_channel_id: str = ''
+    staff_user_ids: Tuple[int, ...] = ()
+    # Stripe secret key (use a test key for testing), optional API base override and webhook signing secret
+    stripe_api_key: str = ''
+    stripe_api_base: str = ''
+    stripe_webhook_secret: str = ''
+    # Connections kept for synchronous Stripe calls (webhook workers), and the HTTP timeout
+    # in seconds; Stripe retries network failures itself
+    stripe_pool_size: int = 8
+    stripe_timeout: float = 10.0
+    stripe_max_retries: int = 2
+    mongo_uri: str = 'mongodb://localhost:27017'
+    mongo_database: str = 'order_bot'
+    # Connection pool, shared with the async repository's thread pool, and socket timeouts
+    mongo_pool_size: int = 20
+    mongo_timeout_ms: int = 5000
+    # Port of the Stripe/Telegram webhook and metrics server
+    http_port: int = 8080
+    # Metrics collection can be switched off entirely; instrumentation then costs nothing
+    metrics_enabled: bool = True
+    # How the order bot receives updates, 'polling' or 'webhook'. In webhook mode Telegram
+    # posts to telegram_webhook_url (path under /telegram) and echoes telegram_webhook_secret
+    telegram_mode: str = 'polling'
+    telegram_webhook_url: str = ''
+    telegram_webhook_secret: str = ''
+    telegram_workers: int = 4
+    # Bot API endpoint; point it at a fake server for offline benchmarks
+    telegram_api_url: str = 'https://api.telegram.org/bot'
+    # Public URL of the webhook server that serves /s/<code> redirects; empty disables local links
+    short_link_base_url: str = ''
+    # Which slice of users a polling worker serves, and how many slices there are
+    bot_shard: int = 0
+    bot_shards: int = 1
+    # Conversation state store, 'mongo' or 'local' (SQLite at state_path)
+    state_backend: str = 'mongo'
+    state_path: str = 'conversation_state.sqlite3'
+    # Log pipeline; log_rates overrides the per-logger rate, e.g. "httpx=5,webhooks=50"
+    log_level: str = 'INFO'
+    log_format: str = 'json'
+    log_queue_size: int = 10000
+    log_rate: float = 50.0
+    log_burst: float = 100.0
+    log_rates: str = ''
+    # Fees in cents. Delivery is charged once per order; pickup_fees sets a fee per
+    # pickup point, e.g. "santos-o-velho=50"
+    delivery_fee_cents: int = 200
+    pickup_fees: str = ''
+    # Volume discounts as "minimum quantity:percent off" pairs, e.g. "10:5,25:10"
+    volume_discounts: str = ''
+    quote_cache_size: int = 4096
+    # At most reaper_batch_size expirations per tick, ticks at most reaper_interval seconds
+    # apart; per-user data is dropped after user_data_ttl seconds without an update
+    reaper_batch_size: int = 50
+    reaper_interval: float = 1.0
+    user_data_ttl: float = 24 * 3600.0
+
+    def require(self, *fields: str) -> 'Config':
+        """Raise ConfigError naming every one of `fields` that is not set."""
+        missing = [env_name(field) for field in fields if not getattr(self, field)]
+        if missing:
+            raise ConfigError(f"Missing required settings: {', '.join(missing)}")
+        return self
+
+
+# Needed to take traffic; tools like `schema.py --check` only need the Mongo settings
+REQUIRED = ('order_bot_key', 'notification_bot_key', 'staff_channel_id', 'stripe_api_key', 'stripe_webhook_secret')
+
+# Settings limited to a fixed set of values
+CHOICES = {
+    'telegram_mode': ('polling', 'webhook'),
+    'state_backend': ('mongo', 'local'),
+    'log_format': ('json', 'text'),
+}
+
+# Sizes and intervals that must be above zero
+POSITIVE = (
+    'stripe_pool_size', 'stripe_timeout', 'mongo_pool_size', 'mongo_timeout_ms', 'telegram_workers', 'bot_shards',
+    'log_queue_size', 'quote_cache_size', 'reaper_batch_size', 'reaper_interval', 'user_data_ttl',
+)
+
+
+def env_name(field: str) -> str:
+    return field.upper()
+
+
+def parse(field: str, value: Any) -> Any:
+    """Coerce a raw file or environment value to the type of the field's default."""
+    default = Config._field_defaults[field]
+    try:
+        if isinstance(default, tuple):
+            if isinstance(value, str):
+                value = [part for part in (part.strip() for part in value.split(',')) if part]
+            return tuple(int(part) for part in value)
+        if isinstance(default, bool):
+            if not isinstance(value, str):
+                return bool(value)
+            if value.strip().lower() not in BOOLEANS:
+                raise ValueError("expected a boolean")
+            return BOOLEANS[value.strip().lower()]
+        if isinstance(default, float):
+            return float(value)
+        if isinstance(default, int):
+            return int(value)
+        return str(value)
+    except (TypeError, ValueError) as e:
+        raise ConfigError(f"{env_name(field)}: invalid value {value!r} ({e})") from None
+
+
+def load(path: str = CONFIG_PATH, environ: Mapping[str, str] = os.environ) -> Config:
+    """Build a Config from the optional JSON file at `path` and then the environment."""
+    values: Dict[str, Any] = {}
+    if path:
+        try:
+            with open(path) as file:
+                values.update(json.load(file))
+        except (OSError, ValueError) as e:
+            raise ConfigError(f"Cannot read config file {path}: {e}") from None
+        unknown = set(values) - set(Config._fields)
+        if unknown:
+            raise ConfigError(f"Unknown settings in {path}: {', '.join(sorted(unknown))}")
+
+    for field in Config._fields:
+        if env_name(field) in environ:
+            values[field] = environ[env_name(field)]
+
+    config = Config(**{field: parse(field, value) for field, value in values.items()})
+    for field in ('order_bot_key', 'notification_bot_key'):
+        token = getattr(config, field)
+        if token and not BOT_TOKEN_PATTERN.match(token):
+            raise ConfigError(f"{env_name(field)}: not a Telegram bot token")
+    if not config.mongo_database:
+        raise ConfigError("MONGO_DATABASE: must not be empty")
+    for field, choices in CHOICES.items():
+        if getattr(config, field) not in choices:
+            raise ConfigError(f"{env_name(field)}: must be one of {', '.join(choices)}")
+    for field in POSITIVE:
+        if getattr(config, field) <= 0:
+            raise ConfigError(f"{env_name(field)}: must be greater than zero")
+    if not 0 <= config.bot_shard < config.bot_shards:
+        raise ConfigError(f"BOT_SHARD: must be between 0 and BOT_SHARDS - 1 ({config.bot_shards - 1})")
+    return config
+
+
+@functools.lru_cache(maxsize=None)
+def settings() -> Config:
+    """The process-wide configuration, loaded and validated on first use."""
+    return load(CONFIG_PATH)
+
+
+def reload() -> Config:
+    """Drop the cached configuration and load it again, e.g. after the environment changed."""
+    settings.cache_clear()
+    return settings()
@@ -1,49 +1,189 @@
 import pymongo
+import logging
+import datetime
+import threading
+from pymongo.errors import (
+    DuplicateKeyError
+)
+from typing import (
+    Any, Callable, Dict, List, Optional
+)
+from catalog import (
+    ProductCatalog,
+    CatalogSnapshot
+)
+from reservations import (
+    StockReservations
+)
+from ledger import (
+    EventLedger
+)
+from cart import (
+    describe_cart
+)
+from reports import (
+    record_order
+)
+from metrics import (
+    mongo_listeners
+)
+from pricing import (
+    pricing,
+    to_cents
+)
+from config import (
+    settings
+)
 
-# create a connection to the MongoDB
-client = pymongo.MongoClient()
+logger = logging.getLogger(__name__)
 
-# create a database
-db = client['']
+_client: Optional[pymongo.MongoClient] = None
+_client_lock = threading.Lock()
 
-# create collections within the database
+
+def get_client() -> pymongo.MongoClient:
+    """The shared MongoDB client, created on first use rather than at import."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            config = settings()
+            _client = pymongo.MongoClient(
+                config.mongo_uri,
+                maxPoolSize=config.mongo_pool_size,
+                serverSelectionTimeoutMS=config.mongo_timeout_ms,
+                connectTimeoutMS=config.mongo_timeout_ms,
+                socketTimeoutMS=config.mongo_timeout_ms,
+                event_listeners=mongo_listeners(),
+            )
+        return _client
+
+
+def get_db():
+    return get_client()[settings().mongo_database]
+
+
+class LazyCollection:
+    """Stands in for a collection and connects on its first use."""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._collection = None
+
+    def __getattr__(self, attr: str) -> Any:
+        if self._collection is None:
+            self._collection = get_db()[self._name]
+        return getattr(self._collection, attr)
+
+
+class LazyDatabase:
+    """Stands in for the database; `db[name]` hands out lazy collections."""
+
+    def __getitem__(self, name: str) -> LazyCollection:
+        return LazyCollection(name)
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(get_db(), attr)
+
+
+def __getattr__(name: str) -> Any:
+    if name == 'client':
+        return get_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# the database and its collections; nothing connects until they are used
+db = LazyDatabase()
 products = db['products']
 orders = db['orders']
 
-# create a list of products to insert
-products_list = [
-    {"id": "1", "name": "", "price": , "stock": },
+# in-memory product catalog shared by the bot handlers
+catalog = ProductCatalog(products)
+
+# stock holds taken while a customer is paying
+reservations = StockReservations(products, db['reservations'], catalog)
+
+# Stripe events that have already been turned into orders
+ledger = EventLedger(db['processed_events'])
+
+# callbacks invoked with every newly inserted order
+order_listeners: List[Callable[[Dict], None]] = []
+
+# create a list of products to insert, e.g. {"id": "1", "name": "Sourdough", "price": 4.5, "stock": 20}
+products_list: List[Dict] = [
 ]
 
 def get_products():
-    return list(products.find({}))
+    return list(catalog.snapshot().products.values())
+
+def decrement_stock(items: List[Dict], order_id=None) -> bool:
+    """Take the stock for every line of a paid order, or for none of them.
 
-def decrement_stock(product: str, quantity: int) -> None:
-    # Retrieve the current stock of the selected product
-    product_doc = products.find_one({"name": product})
-    current_stock = product_doc["stock"]
+    A line that is short means the order was paid for stock that is gone; the lines
+    already taken are given back and the order is marked oversold for staff to sort out.
+    """
+    if reservations.take_items(items):
+        return True
 
-    # Calculate the new stock after decrementing the quantity
-    new_stock = current_stock - quantity
+    logger.error("Insufficient stock for order %s: %s", order_id, describe_cart(items))
+    if order_id is not None:
+        orders.update_one({"_id": order_id}, {"$set": {"status": "oversold"}})
+    return False
 
-    if new_stock < 0:
-        # Stock cannot be negative, handle the insufficient stock scenario
-        print("Insufficient stock for", product)
+def mark_order(order_id, step: str) -> bool:
+    """Atomically flag a one-off step of an order as done; False if it already was."""
+    return orders.update_one({"_id": order_id, step: {"$ne": True}}, {"$set": {step: True}}).modified_count == 1
 
-    # Update the stock in the database
-    products.update_one({"name": product}, {"$set": {"stock": new_stock}})
+def unmark_order(order_id, step: str) -> None:
+    """Clear a step's flag after it failed, so a retry runs it again."""
+    orders.update_one({"_id": order_id}, {"$unset": {step: ""}})
+
+def add_order(items: List[Dict], option: str, location: str, name: str, reservation_id: Optional[str] = None, payment_intent: Optional[str] = None, amount_total: Optional[int] = None) -> None:
+    # Record what each line sold for, in cents, for the sales reports. Checkouts carry
+    # the amount charged; only sessions created before that fall back to the catalog
+    for item in items:
+        if 'unit_amount' not in item:
+            product_doc = catalog.get(item['product'])
+            item['unit_amount'] = pricing.quote_line(item['product'], item['quantity'], to_cents(product_doc['price'])).unit_amount if product_doc else 0
 
-def add_order(product: str, quantity: int, option: str, location: str, name: str) -> None:
     order = {
-        "product": product,
-        "quantity": quantity,
+        "items": items,
         "option": option,
         "location": location,
-        "name": name
+        "name": name,
+        "reservation_id": reservation_id,
+        "payment_intent": payment_intent,
+        "status": "paid",
+        "amount_total": amount_total,
+        "created_at": datetime.datetime.utcnow()
     }
 
     # Insert the order into the "transactions" collection
-    orders.insert_one(order)
+    try:
+        orders.insert_one(order)
+    except DuplicateKeyError:
+        if payment_intent is None:
+            raise
+        # A retry of an order whose first attempt failed part way; finish the steps it missed
+        order = orders.find_one({"payment_intent": payment_intent})
+        logger.info("Order for payment %s already exists, resuming it", payment_intent)
+    else:
+        # Push the order to the in-process notifier
+        for listener in order_listeners:
+            listener(order)
+
+    # Stock held at checkout only needs committing; otherwise take it now, once per order
+    if reservation_id is None or not reservations.commit(reservation_id):
+        if mark_order(order["_id"], "stock_taken"):
+            try:
+                decrement_stock(items, order["_id"])
+            except Exception:
+                unmark_order(order["_id"], "stock_taken")
+                raise
 
-    # Decrement the stock of the ordered product
-    decrement_stock(product, quantity)
\ No newline at end of file
+    # Keep the daily report rollups current, counting each order once
+    if mark_order(order["_id"], "rolled_up"):
+        try:
+            record_order(db, order)
+        except Exception:
+            unmark_order(order["_id"], "rolled_up")
+            raise
@@ -0,0 +1,84 @@
+import logging
+import datetime
+import threading
+from collections import (
+    OrderedDict
+)
+from typing import (
+    Optional
+)
+from pymongo.errors import (
+    DuplicateKeyError
+)
+
+logger = logging.getLogger(__name__)
+
+# Claim lifecycle; claims written before statuses existed count as done
+PROCESSING, DONE = 'processing', 'done'
+
+
+class EventLedger:
+    """Record of Stripe events that have been acted on, so redeliveries are no-ops.
+
+    Claims are keyed by event id, with a unique index on the payment intent (see
+    schema.py), so one payment never produces two orders. A claim stays
+    `processing` until its order exists, so the next delivery resumes it if its
+    worker died. An LRU of recent event ids keeps most duplicate checks in process.
+    """
+
+    def __init__(self, events, cache_size: int = 10000):
+        self.events = events
+        self.cache_size = cache_size
+        self._recent: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, event_id: str) -> bool:
+        """Whether this process has already accepted `event_id`. Never touches the database."""
+        with self._lock:
+            if event_id in self._recent:
+                self._recent.move_to_end(event_id)
+                return True
+            return False
+
+    def remember(self, event_id: str) -> None:
+        with self._lock:
+            self._recent[event_id] = True
+            self._recent.move_to_end(event_id)
+            if len(self._recent) > self.cache_size:
+                self._recent.popitem(last=False)
+
+    def forget(self, event_id: str) -> None:
+        """Let the next delivery of `event_id` through `seen`, e.g. after processing gave up on it."""
+        with self._lock:
+            self._recent.pop(event_id, None)
+
+    def claim(self, event_id: str, payment_intent: Optional[str] = None) -> bool:
+        """Claim an event for processing. Returns False if it, or its payment, is already done.
+
+        An unfinished claim is granted again; order creation is idempotent per payment
+        intent, so the rerun only completes what the first attempt started.
+        """
+        claim = {"_id": event_id, "status": PROCESSING, "claimed_at": datetime.datetime.utcnow()}
+        if payment_intent is not None:
+            claim["payment_intent"] = payment_intent
+
+        try:
+            self.events.insert_one(claim)
+            return True
+        except DuplicateKeyError:
+            query = {"_id": event_id} if payment_intent is None else {"$or": [{"_id": event_id}, {"payment_intent": payment_intent}]}
+            if self.events.find_one({**query, "status": {"$ne": PROCESSING}}, {"_id": 1}) is not None:
+                logger.info("Skipping duplicate Stripe event %s", event_id)
+                return False
+            logger.info("Resuming unfinished Stripe event %s", event_id)
+            return True
+        finally:
+            self.remember(event_id)
+
+    def complete(self, event_id: str) -> None:
+        """Mark a claimed event as done, so later deliveries are skipped."""
+        self.events.update_one({"_id": event_id}, {"$set": {"status": DONE, "completed_at": datetime.datetime.utcnow()}})
+
+    def release(self, event_id: str) -> None:
+        """Drop a claim whose processing failed so a retry can claim it again."""
+        self.events.delete_one({"_id": event_id})
@@ -0,0 +1,207 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import datetime
+import threading
+import contextlib
+import contextvars
+from logging.handlers import (
+    QueueHandler,
+    QueueListener
+)
+from typing import (
+    Dict, Iterator, Optional, TextIO
+)
+from metrics import (
+    registry
+)
+from config import (
+    settings
+)
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# Correlation ids attached to every record logged while they are bound. The order id
+# is the reservation id, which follows a checkout from the bot through the Stripe
+# webhook onto the stored order.
+CORRELATION_IDS = ('order_id', 'user_id')
+_context: Dict[str, contextvars.ContextVar] = {
+    name: contextvars.ContextVar(name, default=None) for name in CORRELATION_IDS
+}
+
+_listener: Optional[QueueListener] = None
+_listener_pid: Optional[int] = None
+
+
+@contextlib.contextmanager
+def bind(**ids) -> Iterator[None]:
+    """Attach correlation ids to records logged inside the block (this task or thread only)."""
+    tokens = [(_context[name], _context[name].set(value)) for name, value in ids.items()]
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def tag(**ids) -> None:
+    """Set correlation ids for the rest of the current task; `bind_update` clears them per update."""
+    for name, value in ids.items():
+        _context[name].set(value)
+
+
+async def bind_update(update, context) -> None:
+    """Handler for an early group that tags the rest of an update's handling with its user."""
+    user = getattr(update, 'effective_user', None)
+    tag(user_id=user.id if user is not None else None, order_id=None)
+
+
+def parse_rates(spec: str) -> Dict[str, float]:
+    rates = {}
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, rate = entry.partition('=')
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+class ContextFilter(logging.Filter):
+    """Copies the bound correlation ids onto each record, unless passed via `extra`."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for name, var in _context.items():
+            if getattr(record, name, None) is None:
+                setattr(record, name, var.get())
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """Per-logger token bucket for records below WARNING.
+
+    Each logger may emit `burst` records at once and `rate` per second after that;
+    the excess is dropped and counted, and the next record let through carries the
+    number suppressed since the last one. Warnings and errors always pass.
+    """
+
+    def __init__(self, rate: float = 50.0, burst: float = 100.0, rates: Optional[Dict[str, float]] = None):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.rates = rates or {}
+        self._buckets: Dict[str, list] = {}
+        self._lock = threading.Lock()
+        self.dropped = registry.counter('log_records_dropped', 'Log records dropped before being written', reason='rate_limited')
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+
+        rate = self.rates.get(record.name, self.rate)
+        now = time.monotonic()
+        with self._lock:
+            # [tokens, last refill, suppressed since last pass]
+            bucket = self._buckets.setdefault(record.name, [self.burst, now, 0])
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                self.dropped.inc()
+                return False
+            bucket[0] -= 1
+            record.suppressed, bucket[2] = bucket[2], 0
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with the correlation ids as top-level fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.datetime.utcfromtimestamp(record.created).isoformat(timespec='milliseconds') + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for name in CORRELATION_IDS:
+            if getattr(record, name, None) is not None:
+                entry[name] = getattr(record, name)
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler that never blocks the caller and leaves formatting to the writer thread."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = registry.counter('log_records_dropped', 'Log records dropped before being written', reason='queue_full')
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Resolve the message now so mutable arguments can't change before it is written
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped.inc()
+
+
+def configure_logging(level: Optional[str] = None, format: Optional[str] = None, stream: Optional[TextIO] = None,
+                      rate: Optional[float] = None, burst: Optional[float] = None, rates: Optional[Dict[str, float]] = None) -> QueueListener:
+    """Route the root logger through a bounded queue drained by a background writer.
+
+    Callers only pay for filtering and a non-blocking enqueue; formatting and the
+    write to `stream` (stderr by default) happen on the writer thread. Calling this
+    again, e.g. in a forked worker process, replaces the previous pipeline. Anything
+    not passed comes from the log_* settings.
+    """
+    global _listener, _listener_pid
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+
+    config = settings()
+    level = level or config.log_level
+    format = format or config.log_format
+    rate = config.log_rate if rate is None else rate
+    burst = config.log_burst if burst is None else burst
+    rates = parse_rates(config.log_rates) if rates is None else rates
+
+    log_queue = queue.Queue(maxsize=config.log_queue_size)
+    writer = logging.StreamHandler(stream or sys.stderr)
+    writer.setFormatter(JsonFormatter() if format == 'json' else logging.Formatter(TEXT_FORMAT))
+
+    handler = NonBlockingQueueHandler(log_queue)
+    handler.addFilter(ContextFilter())
+    handler.addFilter(RateLimitFilter(rate, burst, rates))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    _listener = QueueListener(log_queue, writer)
+    _listener_pid = os.getpid()
+    _listener.start()
+    registry.gauge('log_queue_depth', 'Log records waiting to be written', log_queue.qsize)
+    return _listener
+
+
+def shutdown() -> None:
+    """Write out whatever is still queued."""
+    global _listener
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(shutdown)
@@ -0,0 +1,206 @@
+import time
+import bisect
+import asyncio
+import functools
+import threading
+from typing import (
+    Any, Callable, Dict, List, Sequence, Tuple
+)
+from pymongo import (
+    monitoring
+)
+from config import (
+    settings
+)
+
+# Default latency buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """Fixed-bucket histogram with cheap, thread-safe observations."""
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def percentile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th quantile (0 < q <= 1)."""
+        with self._lock:
+            counts, total = list(self.counts), self.count
+        if total == 0:
+            return 0.0
+
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+        }
+
+
+class Counter:
+    """Monotonic, thread-safe counter."""
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+
+class Registry:
+    """Named metrics with labels, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics: Dict[str, Tuple[str, str, Dict[Tuple, Any]]] = {}
+        self._lock = threading.Lock()
+
+    def register(self, kind: str, name: str, help: str, metric: Any, **labels: str) -> Any:
+        """Expose an existing metric object; returns it for chaining."""
+        with self._lock:
+            _, _, series = self._metrics.setdefault(name, (kind, help, {}))
+            series[tuple(sorted(labels.items()))] = metric
+        return metric
+
+    def _get_or_create(self, kind: str, name: str, help: str, factory: Callable, labels: Dict[str, str]) -> Any:
+        key = tuple(sorted(labels.items()))
+        series = self._metrics.get(name, (None, None, {}))[2]
+        metric = series.get(key)
+        if metric is None:
+            metric = self.register(kind, name, help, factory(), **labels)
+        return metric
+
+    def histogram(self, name: str, help: str, **labels: str) -> Histogram:
+        return self._get_or_create('histogram', name, help, Histogram, labels)
+
+    def counter(self, name: str, help: str, **labels: str) -> Counter:
+        return self._get_or_create('counter', name, help, Counter, labels)
+
+    def gauge(self, name: str, help: str, read: Callable[[], float], **labels: str) -> None:
+        """A value read at scrape time, e.g. a queue depth."""
+        self.register('gauge', name, help, read, **labels)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            metrics = [(name, kind, help, dict(series)) for name, (kind, help, series) in self._metrics.items()]
+
+        for name, kind, help, series in metrics:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in series.items():
+                if kind == 'histogram':
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets + (float('inf'),), list(metric.counts)):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(labels)} {metric.sum}")
+                    lines.append(f"{name}_count{_labels(labels)} {metric.count}")
+                elif kind == 'counter':
+                    lines.append(f"{name}_total{_labels(labels)} {metric.value}")
+                else:
+                    lines.append(f"{name}{_labels(labels)} {metric()}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels: Tuple) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+# shared metrics registry served on /metrics
+registry = Registry()
+
+
+def timed(name: str, help: str, **labels: str) -> Callable:
+    """Record the duration of every call of the decorated (async) function."""
+    def decorator(func: Callable) -> Callable:
+        if not settings().metrics_enabled:
+            return func
+        histogram = registry.histogram(name, help, **labels)
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - started)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def handler(func: Callable) -> Callable:
+    """Time a conversation handler and count the conversation state it moves the user to."""
+    if not settings().metrics_enabled:
+        return func
+    histogram = registry.histogram('bot_handler_seconds', 'Telegram handler latency', handler=func.__name__)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            state = await func(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - started)
+        if isinstance(state, int):
+            registry.counter('bot_funnel_state', 'Conversation state entered, per state', state=STATE_NAMES.get(state, str(state))).inc()
+        return state
+    return wrapper
+
+
+# Filled in by the bot so funnel counters carry readable state names
+STATE_NAMES: Dict[int, str] = {}
+
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """pymongo listener that records the duration of every command by name."""
+
+    def started(self, event) -> None:
+        pass
+
+    def succeeded(self, event) -> None:
+        registry.histogram('mongo_command_seconds', 'MongoDB command latency', command=event.command_name).observe(event.duration_micros / 1e6)
+
+    def failed(self, event) -> None:
+        registry.histogram('mongo_command_seconds', 'MongoDB command latency', command=event.command_name).observe(event.duration_micros / 1e6)
+        registry.counter('mongo_command_failures', 'Failed MongoDB commands', command=event.command_name).inc()
+
+
+def mongo_listeners() -> List[monitoring.CommandListener]:
+    """Event listeners to pass to MongoClient; none when metrics are disabled."""
+    return [MongoCommandTimer()] if settings().metrics_enabled else []
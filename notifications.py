@@ -0,0 +1,294 @@
+import time
+import asyncio
+import logging
+import datetime
+import threading
+from collections import (
+    deque,
+    OrderedDict
+)
+from typing import (
+    AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+)
+from telegram.error import (
+    RetryAfter,
+    TelegramError
+)
+import pymongo
+from pymongo.errors import (
+    PyMongoError
+)
+import database
+from repository import (
+    repository
+)
+from metrics import (
+    Histogram,
+    registry
+)
+
+# Telegram rejects messages longer than this
+MAX_MESSAGE_LENGTH = 4096
+# Separates orders inside a digest message
+DIGEST_SEPARATOR = "\n\n"
+# Backoff bounds, in seconds, when Telegram fails for a reason other than flood control
+SEND_RETRY_DELAY = 1.0
+SEND_RETRY_MAX_DELAY = 60.0
+# Only inserts matter to the notifier
+ORDER_INSERTS = [{'$match': {'operationType': 'insert'}}]
+# Seconds to wait before reopening a change stream that failed
+REOPEN_DELAY = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+class OrderFeed:
+    """Push-based stream of newly inserted orders.
+
+    Uses a Mongo change stream when the server supports one, resuming from the last
+    acknowledged resume token; a stream that fails is reopened from that token, and
+    if it can't be, the feed falls back to the in-process one. That subscribes to
+    `database.add_order` and catches up from a persisted high-water mark (the last
+    notified order `_id`), so a restart neither drops nor repeats notifications.
+    Orders are deduplicated by id, since the catch-up query overlaps the live feed
+    and a reopened stream replays whatever was not yet acknowledged.
+    """
+
+    def __init__(self, orders, state, name: str = 'order_notifier', latency_window: int = 1000, dedupe_window: int = 10000):
+        self.orders = orders
+        self.state = state
+        self.name = name
+        self.queue: Optional[asyncio.Queue] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.last_order_id = None
+        self.resume_token: Optional[Dict] = None
+        self.dedupe_window = dedupe_window
+        self._seen: OrderedDict = OrderedDict()
+        self.latencies = deque(maxlen=latency_window)
+        self.lag = registry.histogram('order_notify_lag_seconds', 'Time from order insertion to staff notification')
+
+    async def stream(self) -> AsyncIterator[Tuple[Dict, Optional[Dict]]]:
+        """Yield `(order, resume_token)` pairs as orders are inserted."""
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+
+        state = await repository.run(self.state.find_one, {'_id': self.name}) or {}
+        self.last_order_id = state.get('last_order_id')
+        self.resume_token = state.get('resume_token')
+
+        if not await self._start_change_stream(self.resume_token):
+            await self._start_local_feed()
+
+        while True:
+            order, token = await self.queue.get()
+            if order['_id'] in self._seen:
+                continue
+            self._seen[order['_id']] = True
+            if len(self._seen) > self.dedupe_window:
+                self._seen.popitem(last=False)
+            yield order, token
+
+    async def acknowledge(self, order: Dict, token: Optional[Dict] = None) -> None:
+        """Persist the high-water mark once `order` has been notified and record its latency."""
+        self.last_order_id = order['_id']
+        update = {'last_order_id': order['_id']}
+        if token is not None:
+            self.resume_token = token
+            update['resume_token'] = token
+        await repository.run(self.state.update_one, {'_id': self.name}, {'$set': update}, upsert=True)
+
+        created_at = order.get('created_at')
+        if created_at is not None:
+            latency = (datetime.datetime.utcnow() - created_at).total_seconds()
+            self.latencies.append(latency)
+            self.lag.observe(latency)
+            logger.info("Order %s notified %.3fs after it was placed", order['_id'], latency)
+
+    def latency_stats(self) -> Dict[str, float]:
+        """End-to-end notify latency over the most recent orders, in seconds."""
+        if not self.latencies:
+            return {'count': 0, 'mean': 0.0, 'max': 0.0}
+        return {
+            'count': len(self.latencies),
+            'mean': sum(self.latencies) / len(self.latencies),
+            'max': max(self.latencies),
+        }
+
+    def publish(self, order: Dict) -> None:
+        """Listener for `database.add_order`; safe to call from any thread."""
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (order, None))
+
+    async def _start_change_stream(self, resume_token: Optional[Dict]) -> bool:
+        try:
+            change_stream = await repository.run(self.orders.watch, ORDER_INSERTS, resume_after=resume_token)
+        except PyMongoError as e:
+            logger.info("Order change stream unavailable, using the in-process feed: %s", e)
+            return False
+
+        thread = threading.Thread(target=self._read_change_stream, args=(change_stream,), daemon=True)
+        thread.start()
+        return True
+
+    def _read_change_stream(self, change_stream) -> None:
+        while True:
+            try:
+                with change_stream:
+                    for change in change_stream:
+                        self.loop.call_soon_threadsafe(self.queue.put_nowait, (change['fullDocument'], change['_id']))
+            except PyMongoError as e:
+                logger.warning("Order change stream failed, reopening it from the last acknowledged order: %s", e)
+
+            time.sleep(REOPEN_DELAY)
+            try:
+                change_stream = self.orders.watch(ORDER_INSERTS, resume_after=self.resume_token)
+            except PyMongoError as e:
+                # E.g. the resume token fell off the oplog; catch up from the high-water mark instead
+                logger.error("Could not reopen the order change stream, using the in-process feed: %s", e)
+                asyncio.run_coroutine_threadsafe(self._start_local_feed(), self.loop)
+                return
+
+    async def _start_local_feed(self) -> None:
+        # Subscribe first so nothing inserted during the catch-up query is missed
+        database.order_listeners.append(self.publish)
+
+        if self.last_order_id is None:
+            # First run: start from the newest order rather than replaying history
+            latest = await repository.latest_order()
+            self.last_order_id = latest['_id'] if latest is not None else None
+            return
+
+        missed = await repository.run(
+            lambda: list(self.orders.find({'_id': {'$gt': self.last_order_id}}).sort('_id', pymongo.ASCENDING))
+        )
+        for order in missed:
+            self.queue.put_nowait((order, None))
+
+
+class TokenBucket:
+    """Allow `rate` sends per second on average with bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """Empty the bucket so nothing is sent for `seconds`, e.g. after a 429."""
+        self.tokens = -seconds * self.rate
+        self.updated_at = time.monotonic()
+
+
+class NotificationSender:
+    """Coalesces queued messages into digests and sends them within Telegram's limits.
+
+    Messages for the same chat that arrive within `window` seconds are joined into
+    one digest. Each chat has its own token bucket; a 429 pauses the chat for the
+    requested `retry_after`, and other Telegram errors are retried with backoff.
+    `bot` only needs an async `send_message(chat_id=..., text=...)`.
+    """
+
+    def __init__(self, bot, window: float = 1.0, rate: float = 1.0, burst: float = 3.0, max_length: int = MAX_MESSAGE_LENGTH):
+        self.bot = bot
+        self.window = window
+        self.rate = rate
+        self.burst = burst
+        self.max_length = max_length
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.send_latency = registry.register('histogram', 'notifier_send_latency_seconds', 'Time notifications wait before delivery', Histogram())
+        registry.gauge('notifier_queue_depth', 'Notifications waiting to be sent', lambda: self.queue.qsize())
+        self.sent_messages = 0
+        self.sent_digests = 0
+        self.retries = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return self.queue.qsize()
+
+    def submit(self, chat_id: str, text: str, on_sent: Optional[Callable[[], Awaitable[None]]] = None) -> None:
+        """Queue `text` for `chat_id`; `on_sent` is awaited once it has been delivered."""
+        self.queue.put_nowait((chat_id, text[:self.max_length], on_sent, time.monotonic()))
+
+    def metrics(self) -> Dict[str, float]:
+        return {
+            'queue_depth': self.queue_depth,
+            'sent_messages': self.sent_messages,
+            'sent_digests': self.sent_digests,
+            'retries': self.retries,
+            **{f'send_latency_{key}': value for key, value in self.send_latency.summary().items()},
+        }
+
+    async def run(self) -> None:
+        pending = None
+        while True:
+            first = pending or await self.queue.get()
+            batch, pending = await self._collect(first)
+            await self._send(batch)
+
+    async def _collect(self, first) -> Tuple[List, Optional[Tuple]]:
+        """Gather messages for the same chat that arrive within the window and fit in one digest."""
+        chat_id = first[0]
+        batch = [first]
+        length = len(first[1])
+        deadline = time.monotonic() + self.window
+
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                return batch, None
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                return batch, None
+
+            if item[0] != chat_id or length + len(DIGEST_SEPARATOR) + len(item[1]) > self.max_length:
+                return batch, item
+            batch.append(item)
+            length += len(DIGEST_SEPARATOR) + len(item[1])
+
+    async def _send(self, batch: List) -> None:
+        chat_id = batch[0][0]
+        text = DIGEST_SEPARATOR.join(item[1] for item in batch)
+        bucket = self.buckets.setdefault(chat_id, TokenBucket(self.rate, self.burst))
+        delay = SEND_RETRY_DELAY
+
+        while True:
+            await bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text)
+                break
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, datetime.timedelta) else e.retry_after
+                logger.warning("Flood limit hit for chat %s, retrying in %ss", chat_id, retry_after)
+                self.retries += 1
+                bucket.pause(retry_after)
+            except TelegramError as e:
+                logger.warning("Sending to chat %s failed, retrying in %ss: %s", chat_id, delay, e)
+                self.retries += 1
+                bucket.pause(delay)
+                delay = min(delay * 2, SEND_RETRY_MAX_DELAY)
+
+        now = time.monotonic()
+        for item in batch:
+            self.send_latency.observe(now - item[3])
+        self.sent_messages += len(batch)
+        self.sent_digests += 1
+
+        for item in batch:
+            if item[2] is not None:
+                try:
+                    await item[2]()
+                except Exception:
+                    # The message went out; a failed acknowledgement only risks a repeat after a restart
+                    logger.exception("Notification sent but its acknowledgement failed")
@@ -0,0 +1,96 @@
+import json
+import time
+import hashlib
+import threading
+from typing import (
+    Any, Dict, List, Optional
+)
+from metrics import (
+    Histogram,
+    registry
+)
+from config import (
+    settings
+)
+
+
+class CheckoutError(Exception):
+    """Stripe could not create or change a checkout session."""
+
+
+class CheckoutClient:
+    """Creates and expires Stripe checkout sessions without blocking the event loop.
+
+    The bot's calls go through the SDK's async methods, served by an httpx client whose
+    connection pool reuses TLS connections to api.stripe.com. Synchronous calls, such
+    as those made from webhook worker threads, share one keep-alive requests session
+    sized by `pool_size`. Stripe retries network failures itself, and every create
+    carries an idempotency key so a retry can never produce a second session for the
+    same checkout. The stripe package is only imported on first use, keeping it off
+    the startup path.
+    """
+
+    def __init__(self, pool_size: Optional[int] = None, timeout: Optional[float] = None, max_retries: Optional[int] = None):
+        config = settings()
+        self.pool_size = pool_size or config.stripe_pool_size
+        self.timeout = timeout or config.stripe_timeout
+        self.max_retries = config.stripe_max_retries if max_retries is None else max_retries
+        self._stripe = None
+        self._lock = threading.Lock()
+        self.latency = registry.register('histogram', 'stripe_checkout_seconds', 'Stripe checkout session creation latency', Histogram())
+
+    def stripe(self):
+        """The configured `stripe` module; importing and configuring it waits for the first call."""
+        with self._lock:
+            if self._stripe is None:
+                import stripe
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                session.mount('https://', adapter)
+
+                config = settings()
+                stripe.api_key = config.stripe_api_key
+                if config.stripe_api_base:
+                    stripe.api_base = config.stripe_api_base
+                stripe.default_http_client = stripe.RequestsClient(
+                    timeout=self.timeout,
+                    session=session,
+                    async_fallback_client=stripe.HTTPXClient(timeout=self.timeout),
+                )
+                stripe.max_network_retries = self.max_retries
+                self._stripe = stripe
+            return self._stripe
+
+    @staticmethod
+    def idempotency_key(user_id: int, cart: List[Dict], attempt: str) -> str:
+        """Derive a stable key from the user, the cart contents and the checkout attempt."""
+        payload = json.dumps({'user': user_id, 'cart': cart, 'attempt': attempt}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    async def create_session(self, idempotency_key: str, **params: Any) -> Any:
+        stripe = self.stripe()
+        started = time.perf_counter()
+        try:
+            return await stripe.checkout.Session.create_async(idempotency_key=idempotency_key, **params)
+        except stripe.StripeError as e:
+            raise CheckoutError(str(e)) from e
+        finally:
+            self.latency.observe(time.perf_counter() - started)
+
+    async def expire_session(self, session_id: str) -> bool:
+        """Expire an open checkout session. Returns False if the customer has already paid."""
+        stripe = self.stripe()
+        try:
+            await stripe.checkout.Session.expire_async(session_id)
+            return True
+        except stripe.InvalidRequestError:
+            # Only open sessions can be expired; a completed one has been paid for
+            session = await stripe.checkout.Session.retrieve_async(session_id)
+            return session.status != 'complete'
+
+
+# shared checkout client
+checkout = CheckoutClient()
@@ -0,0 +1,209 @@
+import copy
+import json
+import asyncio
+import logging
+import sqlite3
+import threading
+from typing import (
+    Any, Dict, List, Optional, Tuple
+)
+from pymongo import (
+    DeleteOne,
+    ReplaceOne
+)
+from telegram import (
+    Update
+)
+from telegram.ext import (
+    ApplicationHandlerStop,
+    BasePersistence,
+    ContextTypes,
+    PersistenceInput
+)
+import database
+from config import (
+    settings
+)
+from repository import (
+    repository
+)
+
+logger = logging.getLogger(__name__)
+
+# Record kinds stored by the backends
+USER, CONVERSATION = 'user', 'conversation'
+
+# (kind, key, shard, value); a value of None deletes the record
+StateWrite = Tuple[str, str, int, Any]
+
+
+def shard_of(user_id: int, shards: int) -> int:
+    return user_id % shards
+
+
+class MongoStateBackend:
+    """Stores conversation records in a Mongo collection, one document per record."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def load(self, kind: str, shard: int) -> Dict[str, Any]:
+        return {doc['key']: doc['value'] for doc in self.collection.find({'kind': kind, 'shard': shard})}
+
+    def write(self, batch: List[StateWrite]) -> None:
+        requests = []
+        for kind, key, shard, value in batch:
+            _id = f'{kind}:{key}'
+            if value is None:
+                requests.append(DeleteOne({'_id': _id}))
+            else:
+                requests.append(ReplaceOne({'_id': _id}, {'kind': kind, 'key': key, 'shard': shard, 'value': value}, upsert=True))
+        self.collection.bulk_write(requests, ordered=False)
+
+
+class LocalStateBackend:
+    """Stores conversation records in an embedded SQLite file."""
+
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS state (id TEXT PRIMARY KEY, kind TEXT, key TEXT, shard INTEGER, value TEXT)'
+            )
+            self.connection.execute('CREATE INDEX IF NOT EXISTS state_kind_shard ON state (kind, shard)')
+
+    def load(self, kind: str, shard: int) -> Dict[str, Any]:
+        with self.lock:
+            rows = self.connection.execute('SELECT key, value FROM state WHERE kind = ? AND shard = ?', (kind, shard)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def write(self, batch: List[StateWrite]) -> None:
+        deletes = [(f'{kind}:{key}',) for kind, key, _, value in batch if value is None]
+        upserts = [(f'{kind}:{key}', kind, key, shard, json.dumps(value)) for kind, key, shard, value in batch if value is not None]
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM state WHERE id = ?', deletes)
+            self.connection.executemany('INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?, ?)', upserts)
+
+
+class ShardedPersistence(BasePersistence):
+    """ConversationHandler states and user_data, persisted per user shard.
+
+    Changes are buffered in memory and written in one batch shortly after the first
+    change of a round, so PTB's per-user update calls cost a single backend write.
+    Each worker loads and serves only the users of its own shard, which lets several
+    bot workers share the update load without stepping on each other's state.
+    """
+
+    def __init__(self, backend, shard: int = 0, shards: int = 1, flush_delay: float = 0.5, update_interval: float = 5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.backend = backend
+        self.shard = shard
+        self.shards = shards
+        self.flush_delay = flush_delay
+        self._pending: Dict[Tuple[str, str], Tuple[int, Any]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def owns(self, user_id: int) -> bool:
+        return shard_of(user_id, self.shards) == self.shard
+
+    async def drop_foreign_updates(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Handler for an early group (-2) that stops updates belonging to another shard."""
+        if update.effective_user is not None and not self.owns(update.effective_user.id):
+            raise ApplicationHandlerStop
+
+    async def get_user_data(self) -> Dict[int, Dict]:
+        records = await repository.run(self.backend.load, USER, self.shard)
+        return {int(key): value for key, value in records.items()}
+
+    async def update_user_data(self, user_id: int, data: Dict) -> None:
+        self._buffer(USER, str(user_id), user_id, copy.deepcopy(data))
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._buffer(USER, str(user_id), user_id, None)
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict) -> None:
+        # This worker is the only writer for its shard, so memory is always current
+        pass
+
+    async def get_conversations(self, name: str) -> Dict:
+        records = await repository.run(self.backend.load, CONVERSATION, self.shard)
+        conversations = {}
+        for key, state in records.items():
+            conversation, conversation_key = json.loads(key)
+            if conversation == name:
+                conversations[tuple(conversation_key)] = state
+        return conversations
+
+    async def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]) -> None:
+        # Conversations are keyed (chat_id, user_id); the user decides the shard
+        self._buffer(CONVERSATION, json.dumps([name, list(key)]), key[-1], new_state)
+
+    async def flush(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self._write()
+
+    def _buffer(self, kind: str, key: str, user_id: int, value: Any) -> None:
+        self._pending[(kind, key)] = (shard_of(user_id, self.shards), value)
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.flush_delay)
+        self._flush_task = None
+        await self._write()
+
+    async def _write(self) -> None:
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        batch = [(kind, key, shard, value) for (kind, key), (shard, value) in pending.items()]
+        try:
+            await repository.run(self.backend.write, batch)
+        except Exception:
+            logger.exception("Failed to persist %d conversation records, keeping them for the next flush", len(batch))
+            # Newer changes made while writing win over the failed batch
+            self._pending = {**pending, **self._pending}
+
+    # Only user data and conversations are persisted
+    async def get_chat_data(self) -> Dict:
+        return {}
+
+    async def get_bot_data(self) -> Dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_chat_data(self, chat_id: int, data: Dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: Dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict) -> None:
+        pass
+
+
+def build_persistence(shard: int, shards: int) -> ShardedPersistence:
+    """Create the persistence configured by the state_backend setting."""
+    config = settings()
+    if config.state_backend == 'local':
+        backend = LocalStateBackend(config.state_path)
+    else:
+        backend = MongoStateBackend(database.db['conversation_state'])
+    return ShardedPersistence(backend, shard, shards)
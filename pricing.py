@@ -0,0 +1,113 @@
+import functools
+from decimal import (
+    Decimal,
+    ROUND_HALF_UP
+)
+from typing import (
+    Dict, List, NamedTuple, Optional, Tuple
+)
+from config import (
+    settings
+)
+
+
+def parse_fees(spec: str) -> Dict[str, int]:
+    fees = {}
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        location, _, fee = entry.partition('=')
+        fees[location.strip()] = int(fee)
+    return fees
+
+
+def parse_discounts(spec: str) -> Tuple[Tuple[int, int], ...]:
+    """Parse "minimum quantity:percent off" pairs; the highest threshold a line reaches applies."""
+    discounts = []
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        quantity, _, percent = entry.partition(':')
+        discounts.append((int(quantity), int(percent)))
+    return tuple(sorted(discounts))
+
+
+def to_cents(price) -> int:
+    """Convert a catalog price in euros to integer cents without float truncation (2.3 -> 230)."""
+    return int((Decimal(str(price)) * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+
+def format_amount(cents: int) -> str:
+    return f"€{cents // 100}.{cents % 100:02d}"
+
+
+class LineQuote(NamedTuple):
+    """Price of one cart line; `unit_amount` is what Stripe charges per unit."""
+    product: str
+    quantity: int
+    list_amount: int
+    unit_amount: int
+    discount: int
+    amount: int
+
+
+class Quote(NamedTuple):
+    """Price of a whole order: the cart lines plus at most one fee."""
+    lines: Tuple[LineQuote, ...]
+    fee_name: str
+    fee: int
+    discount: int
+    total: int
+
+    def items(self) -> List[Dict]:
+        """The cart lines with the unit amount charged, as stored with the checkout."""
+        return [{'product': line.product, 'quantity': line.quantity, 'unit_amount': line.unit_amount} for line in self.lines]
+
+
+class PricingEngine:
+    """Computes order quotes in integer cents.
+
+    Line quotes are memoized per product, quantity and list price, so repeat quotes
+    cost a dictionary lookup and a price change in the catalog simply misses the
+    cache. The same Quote drives the message shown to the customer and the Stripe
+    line items, so the two can't disagree.
+    """
+
+    def __init__(self, delivery_fee: Optional[int] = None, pickup_fees: Dict[str, int] = None,
+                 discounts: Tuple[Tuple[int, int], ...] = None, cache_size: Optional[int] = None):
+        config = settings()
+        self.delivery_fee = config.delivery_fee_cents if delivery_fee is None else delivery_fee
+        self.pickup_fees = parse_fees(config.pickup_fees) if pickup_fees is None else pickup_fees
+        self.discounts = parse_discounts(config.volume_discounts) if discounts is None else tuple(sorted(discounts))
+        self.quote_line = functools.lru_cache(maxsize=cache_size or config.quote_cache_size)(self._quote_line)
+
+    def discount_percent(self, quantity: int) -> int:
+        percent = 0
+        for threshold, discount in self.discounts:
+            if quantity >= threshold:
+                percent = discount
+        return percent
+
+    def _quote_line(self, product: str, quantity: int, list_amount: int) -> LineQuote:
+        # Discount per unit, so quantity x unit_amount is exactly what Stripe charges
+        unit_discount = list_amount * self.discount_percent(quantity) // 100
+        unit_amount = list_amount - unit_discount
+        return LineQuote(product, quantity, list_amount, unit_amount, unit_discount * quantity, unit_amount * quantity)
+
+    def fee(self, option: str, location: str) -> Tuple[str, int]:
+        """The per-order fee for a delivery option, and its name on the receipt."""
+        if option == 'delivery':
+            return 'Delivery', self.delivery_fee
+        return f"Pickup at {location}", self.pickup_fees.get(location, 0)
+
+    def quote(self, lines: List[Dict], option: str, location: str) -> Quote:
+        """Quote `{product, quantity, price}` lines, with prices as stored in the catalog."""
+        quoted = tuple(self.quote_line(line['product'], line['quantity'], to_cents(line['price'])) for line in lines)
+        fee_name, fee = self.fee(option, location)
+        return Quote(
+            lines=quoted,
+            fee_name=fee_name,
+            fee=fee,
+            discount=sum(line.discount for line in quoted),
+            total=sum(line.amount for line in quoted) + fee,
+        )
+
+
+# Shared engine configured from the settings
+pricing = PricingEngine()
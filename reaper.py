@@ -0,0 +1,217 @@
+import time
+import heapq
+import asyncio
+import logging
+import datetime
+import itertools
+from typing import (
+    Dict, List, Optional, Tuple
+)
+from pymongo.errors import (
+    PyMongoError
+)
+from telegram.ext import (
+    Application,
+    ConversationHandler
+)
+import database
+from metrics import (
+    registry
+)
+from config import (
+    settings
+)
+from payments import (
+    checkout
+)
+from repository import (
+    repository
+)
+
+logger = logging.getLogger(__name__)
+
+# What a scheduled entry expires
+CHECKOUT, USER_DATA = 'checkout', 'user_data'
+
+# How often expired holds that never reached the heap are swept up, e.g. when session
+# creation failed after the stock was reserved, and how overdue they must be first
+SWEEP_INTERVAL = 60.0
+SWEEP_GRACE = 60.0
+
+
+def end_conversations(handler: ConversationHandler, user_id: int) -> bool:
+    """End every conversation `user_id` has in `handler`; returns whether there were any.
+
+    PTB has no public API for this; checked against python-telegram-bot 22.8, where
+    `_conversations` maps (chat id, user id) keys to states and, on a persistent
+    handler, tracks deletions so the next update_persistence drops the stored state.
+    """
+    keys = [key for key in handler._conversations if key[-1] == user_id]
+    for key in keys:
+        handler._update_state(ConversationHandler.END, key)
+    return bool(keys)
+
+
+class Reaper:
+    """Expires abandoned checkouts and idle per-user data from one time-ordered heap.
+
+    A checkout's Stripe session is expired and its stock released when the hold
+    runs out, unless it was paid. A user idle for the whole TTL has their data
+    dropped and their conversations ended. Holds the heap lost, e.g. to a restart,
+    are swept from the database every `SWEEP_INTERVAL` seconds.
+    """
+
+    def __init__(self, batch_size: Optional[int] = None, interval: Optional[float] = None, user_data_ttl: Optional[float] = None):
+        config = settings()
+        self.batch_size = batch_size or config.reaper_batch_size
+        self.interval = interval or config.reaper_interval
+        self.user_data_ttl = config.user_data_ttl if user_data_ttl is None else user_data_ttl
+        self.application: Optional[Application] = None
+        self._heap: List[Tuple[float, int, str, Tuple]] = []
+        self._seq = itertools.count()
+        self._tracked: Dict[str, int] = {CHECKOUT: 0, USER_DATA: 0}
+        self._last_seen: Dict[int, float] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._swept_at = 0.0
+        self.reaped = {kind: registry.counter('reaper_expired', 'Entries expired by the reaper', entry=kind) for kind in self._tracked}
+        for kind in self._tracked:
+            registry.gauge('reaper_tracked', 'Entries waiting to expire', lambda kind=kind: self._tracked[kind], entry=kind)
+        registry.gauge('reaper_lag_seconds', 'How far the oldest due entry is overdue', self.lag)
+
+    def tracked(self) -> Dict[str, int]:
+        """How many checkouts and users are waiting to expire."""
+        return dict(self._tracked)
+
+    def lag(self) -> float:
+        """Seconds the oldest entry has been overdue; 0 when the reaper is keeping up."""
+        try:
+            due = self._heap[0][0]
+        except IndexError:
+            return 0.0
+        return max(0.0, time.time() - due)
+
+    def _push(self, due: float, kind: str, key: Tuple) -> None:
+        heapq.heappush(self._heap, (due, next(self._seq), kind, key))
+        self._tracked[kind] += 1
+
+    def track_checkout(self, reservation_id: str, session_id: Optional[str], expires_at: float) -> None:
+        """Expire a checkout and release its stock at `expires_at` (epoch seconds) unless it is paid."""
+        self._push(expires_at, CHECKOUT, (reservation_id, session_id))
+
+    async def touch_update(self, update, context) -> None:
+        """Handler for an early group that records each user's last activity.
+
+        Register it after the shard check, so a worker only tracks its own users.
+        """
+        user = getattr(update, 'effective_user', None)
+        if user is None:
+            return
+        now = time.time()
+        if user.id not in self._last_seen:
+            self._push(now + self.user_data_ttl, USER_DATA, (user.id,))
+        self._last_seen[user.id] = now
+
+    def attach(self, application: Application) -> None:
+        """Serve `application`'s users; it starts and stops the reaper with itself."""
+        self.application = application
+        application.post_init = self.start
+        application.post_shutdown = self.stop
+
+    async def start(self, application: Application) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self, application: Application) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def recover(self) -> None:
+        """Track the holds this shard left open before a restart."""
+        persistence = self.application.persistence if self.application else None
+        shard, shards = (persistence.shard, persistence.shards) if persistence is not None else (0, 1)
+        for reservation in await repository.run(database.reservations.held, shard, shards):
+            expires_at = reservation['expires_at'].replace(tzinfo=datetime.timezone.utc).timestamp()
+            self.track_checkout(reservation['_id'], reservation.get('session_id'), expires_at)
+
+    async def run(self) -> None:
+        # Recovery runs in the background so a worker takes updates straight away
+        try:
+            await self.recover()
+        except PyMongoError as e:
+            logger.warning("Could not recover open checkouts, they will be released by Stripe's expiry webhook: %s", e)
+
+        while True:
+            now = time.time()
+            batch = []
+            while self._heap and self._heap[0][0] <= now and len(batch) < self.batch_size:
+                due, _, kind, key = heapq.heappop(self._heap)
+                self._tracked[kind] -= 1
+                batch.append((kind, key))
+
+            for kind, key in batch:
+                try:
+                    if kind == CHECKOUT:
+                        await self._expire_checkout(*key)
+                    else:
+                        await self._expire_user(*key)
+                except Exception:
+                    logger.exception("Failed to expire %s %s, retrying later", kind, key[0])
+                    self._push(time.time() + 60, kind, key)
+
+            if time.monotonic() - self._swept_at >= SWEEP_INTERVAL:
+                self._swept_at = time.monotonic()
+                await self._sweep()
+
+            # A full batch means more is due; yield and go again straight away
+            if len(batch) == self.batch_size:
+                await asyncio.sleep(0)
+                continue
+            wait = self._heap[0][0] - time.time() if self._heap else self.interval
+            await asyncio.sleep(min(max(wait, 0), self.interval))
+
+    async def _sweep(self) -> None:
+        # Backstop for holds orphaned between reserve() and track_checkout()
+        try:
+            released = await repository.run(database.reservations.release_expired, self.batch_size, SWEEP_GRACE)
+        except PyMongoError as e:
+            logger.warning("Could not sweep expired reservations: %s", e)
+            return
+        self.reaped[CHECKOUT].inc(released)
+
+    async def _expire_checkout(self, reservation_id: str, session_id: Optional[str]) -> None:
+        # An open session is closed first so the customer can't pay for stock given back
+        if session_id and not await checkout.expire_session(session_id):
+            return
+        if await repository.release(reservation_id):
+            self.reaped[CHECKOUT].inc()
+            logger.info("Expired abandoned checkout %s", reservation_id, extra={'order_id': reservation_id})
+
+    async def _expire_user(self, user_id: int) -> None:
+        last_seen = self._last_seen.get(user_id, 0)
+        due = last_seen + self.user_data_ttl
+        if due > time.time():
+            self._push(due, USER_DATA, (user_id,))
+            return
+
+        self._last_seen.pop(user_id, None)
+        if self.application is None:
+            return
+        ended = self._end_conversations(user_id)
+        if user_id in self.application.user_data:
+            self.application.drop_user_data(user_id)
+            ended = True
+        if ended:
+            self.reaped[USER_DATA].inc()
+
+    def _end_conversations(self, user_id: int) -> bool:
+        ended = False
+        for handlers in self.application.handlers.values():
+            for handler in handlers:
+                if isinstance(handler, ConversationHandler) and end_conversations(handler, user_id):
+                    ended = True
+        return ended
+
+
+# shared reaper, attached to the order bot's application
+reaper = Reaper()
@@ -0,0 +1,119 @@
+import datetime
+from typing import (
+    Dict, Iterator, List, Optional
+)
+from pymongo import (
+    UpdateOne
+)
+
+# Rollup collections maintained by record_order
+DAILY_SALES = 'daily_sales'
+DAILY_ORDERS = 'daily_orders'
+
+# Report name -> rollup collection and the fields rows are grouped by
+REPORTS = {
+    'product': (DAILY_SALES, ('product',)),
+    'day': (DAILY_SALES, ('day',)),
+    'location': (DAILY_SALES, ('location',)),
+    'option': (DAILY_ORDERS, ('option',)),
+}
+
+
+def order_location(option: str, location: str) -> str:
+    """Pickup orders are reported per pickup point; delivery addresses are grouped together."""
+    return location if option == 'pickup' else 'delivery'
+
+
+def record_order(db, order: Dict) -> None:
+    """Fold one order into the daily rollups so reports never have to scan orders."""
+    day = order['created_at'].strftime('%Y-%m-%d')
+    location = order_location(order['option'], order['location'])
+
+    db[DAILY_SALES].bulk_write([
+        UpdateOne(
+            {'_id': f"{day}|{item['product']}|{location}"},
+            {
+                '$setOnInsert': {'day': day, 'product': item['product'], 'location': location},
+                '$inc': {'units': item['quantity'], 'revenue_cents': item.get('unit_amount', 0) * item['quantity']},
+            },
+            upsert=True,
+        )
+        for item in order['items']
+    ], ordered=False)
+
+    db[DAILY_ORDERS].update_one(
+        {'_id': f"{day}|{order['option']}|{location}"},
+        {
+            '$setOnInsert': {'day': day, 'option': order['option'], 'location': location},
+            '$inc': {'orders': 1, 'revenue_cents': order.get('amount_total') or 0},
+        },
+        upsert=True,
+    )
+
+
+def rebuild_rollups(db, since: Optional[datetime.datetime] = None) -> None:
+    """Recompute the rollups from the orders collection on the server, e.g. after a backfill."""
+    # Oversold orders were paid for too; they count until staff refund them
+    match = {'status': {'$in': ['paid', 'oversold']}}
+    if since is not None:
+        match['created_at'] = {'$gte': since}
+    day = {'$dateToString': {'format': '%Y-%m-%d', 'date': '$created_at'}}
+    location = {'$cond': [{'$eq': ['$option', 'pickup']}, '$location', 'delivery']}
+
+    db['orders'].aggregate([
+        {'$match': match},
+        {'$unwind': '$items'},
+        {'$group': {
+            '_id': {'day': day, 'product': '$items.product', 'location': location},
+            'units': {'$sum': '$items.quantity'},
+            'revenue_cents': {'$sum': {'$multiply': [{'$ifNull': ['$items.unit_amount', 0]}, '$items.quantity']}},
+        }},
+        {'$project': {
+            '_id': {'$concat': ['$_id.day', '|', '$_id.product', '|', '$_id.location']},
+            'day': '$_id.day', 'product': '$_id.product', 'location': '$_id.location',
+            'units': 1, 'revenue_cents': 1,
+        }},
+        {'$merge': {'into': DAILY_SALES, 'whenMatched': 'replace'}},
+    ])
+
+    db['orders'].aggregate([
+        {'$match': match},
+        {'$group': {
+            '_id': {'day': day, 'option': '$option', 'location': location},
+            'orders': {'$sum': 1},
+            'revenue_cents': {'$sum': {'$ifNull': ['$amount_total', 0]}},
+        }},
+        {'$project': {
+            '_id': {'$concat': ['$_id.day', '|', '$_id.option', '|', '$_id.location']},
+            'day': '$_id.day', 'option': '$_id.option', 'location': '$_id.location',
+            'orders': 1, 'revenue_cents': 1,
+        }},
+        {'$merge': {'into': DAILY_ORDERS, 'whenMatched': 'replace'}},
+    ])
+
+
+def report(db, name: str, days: int = 7, batch_size: int = 100) -> Iterator[Dict]:
+    """Stream the rows of report `name` over the last `days` days, aggregated on the server."""
+    collection, group_by = REPORTS[name]
+    since = (datetime.datetime.utcnow() - datetime.timedelta(days=days - 1)).strftime('%Y-%m-%d')
+    count_field = '$units' if collection == DAILY_SALES else '$orders'
+
+    pipeline = [
+        {'$match': {'day': {'$gte': since}}},
+        {'$group': {
+            '_id': {field: f'${field}' for field in group_by},
+            'count': {'$sum': count_field},
+            'revenue_cents': {'$sum': '$revenue_cents'},
+        }},
+        {'$sort': {'revenue_cents': -1} if name != 'day' else {'_id.day': 1}},
+    ]
+    for row in db[collection].aggregate(pipeline, batchSize=batch_size):
+        yield {**row['_id'], 'count': row['count'], 'revenue_cents': row['revenue_cents']}
+
+
+def format_rows(name: str, rows: List[Dict]) -> str:
+    unit = 'units' if REPORTS[name][0] == DAILY_SALES else 'orders'
+    return "\n".join(
+        f"{row[name]}: {row['count']} {unit}, €{row['revenue_cents'] / 100:.2f}"
+        for row in rows
+    )
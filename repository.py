@@ -0,0 +1,67 @@
+import asyncio
+import functools
+from concurrent.futures import (
+    ThreadPoolExecutor
+)
+from typing import (
+    Any, Callable, Dict, List, Optional
+)
+import pymongo
+import database
+from config import (
+    settings
+)
+
+
+class AsyncRepository:
+    """Awaitable front for `database`, used by the telegram handlers and the notifier.
+
+    pymongo is blocking, so each call runs on a dedicated thread pool sized to the
+    Mongo connection pool; the event loop never waits on a socket. Catalog reads that
+    can be answered from a fresh in-memory snapshot skip the thread hop entirely.
+    The module-level functions in `database` remain the sync facade for the webhook
+    thread.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or settings().mongo_pool_size, thread_name_prefix='mongo')
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def catalog_snapshot(self) -> database.CatalogSnapshot:
+        if database.catalog.is_fresh():
+            return database.catalog.snapshot()
+        return await self.run(database.catalog.snapshot)
+
+    async def available_products(self) -> List[Dict]:
+        snapshot = await self.catalog_snapshot()
+        return snapshot.available
+
+    async def get_product(self, name: str) -> Optional[Dict]:
+        snapshot = await self.catalog_snapshot()
+        return snapshot.products.get(name)
+
+    async def get_product_by_id(self, id: str) -> Optional[Dict]:
+        snapshot = await self.catalog_snapshot()
+        return snapshot.by_id.get(id)
+
+    async def reserve(self, items: List[Dict], user_id: Optional[int] = None) -> Optional[str]:
+        return await self.run(database.reservations.reserve, items, user_id=user_id)
+
+    async def release(self, reservation_id: str) -> bool:
+        return await self.run(database.reservations.release, reservation_id)
+
+    async def add_order(self, *args, **kwargs) -> None:
+        return await self.run(database.add_order, *args, **kwargs)
+
+    async def latest_order(self) -> Optional[Dict]:
+        return await self.run(database.orders.find_one, sort=[('_id', pymongo.DESCENDING)])
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False)
+
+
+# shared repository instance
+repository = AsyncRepository()
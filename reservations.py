@@ -0,0 +1,148 @@
+import uuid
+import logging
+import datetime
+from typing import (
+    Dict, List, Optional
+)
+from pymongo import (
+    ReturnDocument,
+    UpdateOne
+)
+
+logger = logging.getLogger(__name__)
+
+# Reservation lifecycle
+HELD, COMMITTED, RELEASED = 'held', 'committed', 'released'
+
+# Stripe refuses checkout sessions that expire less than 30 minutes after it receives
+# them, so holds run a little longer to absorb request latency and clock skew
+CHECKOUT_MIN_SECONDS = 1800
+CHECKOUT_EXPIRY_MARGIN = 120
+HOLD_SECONDS = CHECKOUT_MIN_SECONDS + CHECKOUT_EXPIRY_MARGIN
+
+
+class StockReservations:
+    """Time-bounded stock holds backed by atomic, conditional stock updates.
+
+    `reserve` takes stock for each cart line with a single `$inc` guarded by
+    `stock >= quantity`, so concurrent callers can never drive stock negative; if any
+    line is short, the lines already taken are given back. The hold is then either
+    committed when the payment completes or released (stock given back) when the
+    checkout expires. Every state change is a conditional update on the reservation's
+    status, which makes commit and release safe to call more than once.
+    """
+
+    def __init__(self, products, reservations, catalog=None, hold_seconds: int = HOLD_SECONDS):
+        self.products = products
+        self.reservations = reservations
+        self.catalog = catalog
+        self.hold_seconds = hold_seconds
+
+    def take(self, product: str, quantity: int) -> bool:
+        """Atomically remove `quantity` units from stock, failing if there isn't enough."""
+        result = self.products.update_one(
+            {"name": product, "stock": {"$gte": quantity}},
+            {"$inc": {"stock": -quantity}},
+        )
+        self._invalidate()
+        return result.modified_count == 1
+
+    def take_items(self, items: List[Dict]) -> bool:
+        """Take stock for every `{product, quantity}` line, or for none of them."""
+        taken = []
+        for item in items:
+            if not self.take(item['product'], item['quantity']):
+                self.give_back_items(taken)
+                return False
+            taken.append(item)
+        return True
+
+    def give_back_items(self, items: List[Dict]) -> None:
+        """Return stock for every line in a single bulk write."""
+        if not items:
+            return
+        self.products.bulk_write(
+            [UpdateOne({"name": item['product']}, {"$inc": {"stock": item['quantity']}}) for item in items],
+            ordered=False,
+        )
+        self._invalidate()
+
+    def reserve(self, items: List[Dict], hold_seconds: Optional[int] = None, user_id: Optional[int] = None) -> Optional[str]:
+        """Hold stock for the cart `items` and return the reservation id, or None if any line is short."""
+        if not self.take_items(items):
+            return None
+
+        now = datetime.datetime.utcnow()
+        reservation_id = uuid.uuid4().hex
+        self.reservations.insert_one({
+            "_id": reservation_id,
+            "items": items,
+            "user_id": user_id,
+            "status": HELD,
+            "created_at": now,
+            "expires_at": now + datetime.timedelta(seconds=hold_seconds or self.hold_seconds),
+        })
+        return reservation_id
+
+    def attach_session(self, reservation_id: str, session_id: str, expires_at: Optional[float] = None) -> None:
+        """Remember the checkout session paying for a hold, so it can be expired later.
+
+        `expires_at` (epoch seconds) is the session's expiry; the hold is moved to it so
+        stock is never released while the customer can still pay.
+        """
+        update = {"session_id": session_id}
+        if expires_at is not None:
+            update["expires_at"] = datetime.datetime.utcfromtimestamp(expires_at)
+        self.reservations.update_one({"_id": reservation_id}, {"$set": update})
+
+    def held(self, shard: int = 0, shards: int = 1) -> List[Dict]:
+        """Open holds taken by the users of one bot shard (all of them when unsharded)."""
+        query = {"status": HELD}
+        if shards > 1:
+            query["user_id"] = {"$mod": [shards, shard]}
+        return list(self.reservations.find(query, {"session_id": 1, "expires_at": 1, "user_id": 1}))
+
+    def commit(self, reservation_id: str) -> bool:
+        """Turn a held reservation into a sale. Returns False if it was released instead.
+
+        Committing an already committed reservation returns True, so a retried order
+        never takes its stock a second time.
+        """
+        result = self.reservations.update_one(
+            {"_id": reservation_id, "status": HELD},
+            {"$set": {"status": COMMITTED, "committed_at": datetime.datetime.utcnow()}},
+        )
+        if result.modified_count == 1:
+            return True
+        return self.reservations.count_documents({"_id": reservation_id, "status": COMMITTED}, limit=1) == 1
+
+    def release(self, reservation_id: str) -> bool:
+        """Give a held reservation's stock back. Returns False if it is no longer held."""
+        reservation = self.reservations.find_one_and_update(
+            {"_id": reservation_id, "status": HELD},
+            {"$set": {"status": RELEASED, "released_at": datetime.datetime.utcnow()}},
+            return_document=ReturnDocument.BEFORE,
+        )
+        if reservation is None:
+            return False
+
+        self.give_back_items(reservation['items'])
+        return True
+
+    def release_expired(self, limit: int = 100, grace: float = 0) -> int:
+        """Release up to `limit` holds expired more than `grace` seconds ago; returns how many were released."""
+        now = datetime.datetime.utcnow() - datetime.timedelta(seconds=grace)
+        expired = self.reservations.find({"status": HELD, "expires_at": {"$lte": now}}, {"_id": 1}).limit(limit)
+
+        released = 0
+        for reservation in expired:
+            if self.release(reservation['_id']):
+                released += 1
+
+        if released:
+            logger.info("Released %d expired reservations", released)
+        return released
+
+    def _invalidate(self) -> None:
+        if self.catalog is not None:
+            self.catalog.invalidate()
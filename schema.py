@@ -0,0 +1,181 @@
+"""Index and schema bootstrap for the order bot's collections.
+
+Run at startup to create missing indexes and apply pending migrations, or from the
+command line to check that the hot queries are served by an index:
+
+    python schema.py --check
+"""
+import sys
+import logging
+import argparse
+import datetime
+from typing import (
+    Callable, Dict, Iterator, List, Optional, Tuple
+)
+import pymongo
+from pymongo import (
+    IndexModel
+)
+from pymongo.errors import (
+    DuplicateKeyError
+)
+
+logger = logging.getLogger(__name__)
+
+ASC, DESC = pymongo.ASCENDING, pymongo.DESCENDING
+
+# Indexes every collection should have, by collection name
+INDEXES: Dict[str, List[IndexModel]] = {
+    'products': [
+        IndexModel([('id', ASC)], name='products_id', unique=True, partialFilterExpression={'id': {'$exists': True}}),
+        IndexModel([('name', ASC)], name='products_name', unique=True),
+        IndexModel([('stock', ASC)], name='products_in_stock', partialFilterExpression={'stock': {'$gt': 0}}),
+    ],
+    'orders': [
+        IndexModel([('created_at', DESC)], name='orders_created_at'),
+        IndexModel([('status', ASC), ('created_at', DESC)], name='orders_status'),
+        IndexModel([('payment_intent', ASC)], name='orders_payment_intent', unique=True, partialFilterExpression={'payment_intent': {'$type': 'string'}}),
+    ],
+    'reservations': [
+        IndexModel([('status', ASC), ('expires_at', ASC)], name='reservations_expiry'),
+    ],
+    'processed_events': [
+        IndexModel([('payment_intent', ASC)], name='processed_events_payment_intent', unique=True, partialFilterExpression={'payment_intent': {'$type': 'string'}}),
+    ],
+    'webhook_events': [
+        IndexModel([('status', ASC)], name='webhook_events_status'),
+    ],
+    'daily_sales': [
+        IndexModel([('day', ASC)], name='daily_sales_day'),
+    ],
+    'daily_orders': [
+        IndexModel([('day', ASC)], name='daily_orders_day'),
+    ],
+    'short_links': [
+        # Links are deleted once their checkout session has expired
+        IndexModel([('expires_at', ASC)], name='short_links_expiry', expireAfterSeconds=0),
+    ],
+    'conversation_state': [
+        IndexModel([('kind', ASC), ('shard', ASC)], name='conversation_state_shard'),
+    ],
+}
+
+# (collection, filter, sort) for every query on a hot path
+HOT_QUERIES: List[Tuple[str, Dict, Optional[List]]] = [
+    ('products', {'name': 'example'}, None),
+    ('products', {'id': 'example'}, None),
+    ('products', {'stock': {'$gt': 0}}, None),
+    ('orders', {}, [('_id', DESC)]),
+    ('orders', {'_id': {'$gt': 0}}, [('_id', ASC)]),
+    ('orders', {'payment_intent': 'pi_example'}, None),
+    ('orders', {'status': 'paid'}, [('created_at', DESC)]),
+    ('reservations', {'status': 'held', 'expires_at': {'$lte': datetime.datetime(2000, 1, 1)}}, None),
+    ('webhook_events', {'status': 'pending'}, None),
+    ('conversation_state', {'kind': 'user', 'shard': 0}, None),
+    ('short_links', {'_id': 'example'}, None),
+    ('daily_sales', {'day': {'$gte': '2000-01-01'}}, None),
+    ('daily_orders', {'day': {'$gte': '2000-01-01'}}, None),
+]
+
+
+def migrate_legacy_orders(db) -> None:
+    """Orders from before carts: fold product/quantity into items and backfill status and created_at."""
+    for order in db['orders'].find({'items': {'$exists': False}}):
+        db['orders'].update_one({'_id': order['_id']}, {
+            '$set': {
+                'items': [{'product': order.get('product'), 'quantity': order.get('quantity')}],
+                'status': order.get('status', 'paid'),
+                'created_at': order.get('created_at') or order['_id'].generation_time.replace(tzinfo=None),
+            },
+            '$unset': {'product': '', 'quantity': ''},
+        })
+
+
+# Applied in order, once each; never reorder or remove entries
+MIGRATIONS: List[Tuple[str, Callable]] = [
+    ('0001_legacy_orders', migrate_legacy_orders),
+]
+
+
+def ensure_indexes(db) -> None:
+    """Create any missing index; existing ones are left untouched."""
+    for collection, indexes in INDEXES.items():
+        db[collection].create_indexes(indexes)
+
+
+def missing_indexes(db) -> List[str]:
+    """Names of the indexes in INDEXES that don't exist yet."""
+    missing = []
+    for collection, indexes in INDEXES.items():
+        existing = set(db[collection].index_information())
+        missing.extend(f"{collection}.{index.document['name']}" for index in indexes if index.document['name'] not in existing)
+    return missing
+
+
+def migrate(db) -> None:
+    """Apply pending migrations and record them in the migrations collection.
+
+    Workers may bootstrap concurrently, so every migration must be safe to run twice.
+    """
+    applied = {migration['_id'] for migration in db['migrations'].find({}, {'_id': 1})}
+    for name, migration in MIGRATIONS:
+        if name in applied:
+            continue
+        logger.info("Applying migration %s", name)
+        migration(db)
+        try:
+            db['migrations'].insert_one({'_id': name, 'applied_at': datetime.datetime.utcnow()})
+        except DuplicateKeyError:
+            # Another worker bootstrapping at the same time got there first; migrations are idempotent
+            logger.info("Migration %s was recorded by another process", name)
+
+
+def bootstrap(db) -> None:
+    migrate(db)
+    ensure_indexes(db)
+    missing = missing_indexes(db)
+    if missing:
+        raise RuntimeError(f"Indexes missing after bootstrap: {', '.join(missing)}")
+
+
+def plan_stages(plan: Dict) -> Iterator[str]:
+    """Every stage name in an explain() plan tree."""
+    if 'stage' in plan:
+        yield plan['stage']
+    for key in ('inputStage', 'queryPlan'):
+        if key in plan:
+            yield from plan_stages(plan[key])
+    for child in plan.get('inputStages', []):
+        yield from plan_stages(child)
+
+
+def collection_scans(db) -> List[str]:
+    """The hot queries whose winning plan falls back to a COLLSCAN."""
+    scans = []
+    for collection, query, sort in HOT_QUERIES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain()['queryPlanner']['winningPlan']
+        if 'COLLSCAN' in set(plan_stages(plan)):
+            scans.append(f"{collection}.find({query}){f'.sort({sort})' if sort else ''}")
+    return scans
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--check', action='store_true', help='fail if a hot query would scan a whole collection')
+    args = parser.parse_args()
+
+    import database
+    bootstrap(database.db)
+
+    if args.check:
+        scans = collection_scans(database.db)
+        for scan in scans:
+            print(f"COLLSCAN: {scan}")
+        sys.exit(1 if scans else 0)
+
+
+if __name__ == '__main__':
+    main()
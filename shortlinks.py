@@ -0,0 +1,130 @@
+import time
+import asyncio
+import logging
+import secrets
+import datetime
+import threading
+from collections import (
+    OrderedDict
+)
+from typing import (
+    Optional
+)
+from pymongo.errors import (
+    DuplicateKeyError
+)
+import database
+from metrics import (
+    timed
+)
+from config import (
+    settings
+)
+
+logger = logging.getLogger(__name__)
+
+# Route prefix of the redirect endpoint
+SHORT_LINK_PREFIX = '/s/'
+
+
+class ShortLinkStore:
+    """Code-to-URL store for payment links, shared by every process through MongoDB.
+
+    Each link lives until the checkout session it points at expires; a TTL index on
+    `expires_at` removes it from the collection afterwards. Links are written to the
+    collection when created, so a code made by one bot worker resolves in the webhook
+    server's process and after a restart. A bounded LRU of codes in front of the
+    collection serves repeat lookups from memory, and another LRU keyed by the target
+    URL returns the existing code when the same URL is shortened again.
+    """
+
+    def __init__(self, collection, base_url: Optional[str] = None, ttl: float = 1800, cache_size: int = 1024, code_bytes: int = 5):
+        self.collection = collection
+        self.base_url = (settings().short_link_base_url if base_url is None else base_url).rstrip('/')
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.code_bytes = code_bytes
+        self._links: OrderedDict = OrderedDict()
+        self._recent: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.base_url)
+
+    def shorten(self, url: str, expires_at: Optional[float] = None) -> str:
+        """Return a short link for `url` that stops resolving at `expires_at` (epoch seconds)."""
+        now = time.time()
+        expires_at = expires_at or now + self.ttl
+
+        with self._lock:
+            code = self._recent.get(url)
+            if code is not None and code in self._links and self._links[code][1] > now:
+                self._recent.move_to_end(url)
+                return self.base_url + SHORT_LINK_PREFIX + code
+
+        while True:
+            code = secrets.token_urlsafe(self.code_bytes)
+            try:
+                self.collection.insert_one({
+                    "_id": code,
+                    "url": url,
+                    "expires_at": datetime.datetime.utcfromtimestamp(expires_at),
+                })
+                break
+            except DuplicateKeyError:
+                continue
+
+        with self._lock:
+            self._cache(code, url, expires_at)
+            self._recent[url] = code
+            if len(self._recent) > self.cache_size:
+                self._recent.popitem(last=False)
+
+        return self.base_url + SHORT_LINK_PREFIX + code
+
+    def resolve(self, code: str) -> Optional[str]:
+        """Return the target URL for `code`, or None if it is unknown or expired."""
+        with self._lock:
+            link = self._links.get(code)
+
+        if link is None:
+            # Made by another process or before a restart
+            document = self.collection.find_one({"_id": code})
+            if document is None:
+                return None
+            link = (document['url'], document['expires_at'].replace(tzinfo=datetime.timezone.utc).timestamp())
+            with self._lock:
+                self._cache(code, *link)
+
+        url, expires_at = link
+        # The TTL monitor only runs once a minute, so expiry is checked here too
+        if expires_at <= time.time():
+            with self._lock:
+                self._links.pop(code, None)
+            return None
+        return url
+
+    def _cache(self, code: str, url: str, expires_at: float) -> None:
+        self._links[code] = (url, expires_at)
+        self._links.move_to_end(code)
+        if len(self._links) > self.cache_size:
+            self._links.popitem(last=False)
+
+
+@timed('shortener_external_seconds', 'External URL shortener latency')
+async def shorten_external(url: str) -> str:
+    """Shorten `url` with TinyURL, falling back to the original URL if that fails."""
+    def shorten() -> str:
+        import pyshorteners
+        return pyshorteners.Shortener().tinyurl.short(url)
+
+    try:
+        return await asyncio.to_thread(shorten)
+    except Exception as e:
+        logger.warning("External URL shortener failed, sending the full link: %s", e)
+        return url
+
+
+# shared short link store
+short_links = ShortLinkStore(database.db['short_links'])
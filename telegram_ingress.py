@@ -0,0 +1,117 @@
+import hmac
+import json
+import logs
+import asyncio
+import logging
+import multiprocessing
+from typing import (
+    Callable, Dict, List, Optional
+)
+from telegram import (
+    Update
+)
+from telegram.ext import (
+    Application
+)
+from config import (
+    settings
+)
+
+logger = logging.getLogger(__name__)
+
+# Path prefix of the webhook route; the telegram_webhook_url setting must point under it
+TELEGRAM_WEBHOOK_PATH = '/telegram'
+
+# Update fields that carry the user (or chat) an update belongs to
+UPDATE_FIELDS = (
+    'message', 'edited_message', 'channel_post', 'edited_channel_post', 'callback_query',
+    'my_chat_member', 'chat_member', 'chat_join_request', 'inline_query', 'chosen_inline_result',
+    'shipping_query', 'pre_checkout_query',
+)
+
+
+def routing_key(update: Dict) -> int:
+    """The sender's user id, falling back to the chat and then the update id.
+
+    Workers shard conversation state by user id, so updates are routed on it too.
+    """
+    for field in UPDATE_FIELDS:
+        payload = update.get(field)
+        if not payload:
+            continue
+        if payload.get('from'):
+            return payload['from']['id']
+        chat = payload.get('chat') or (payload.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+    return update.get('update_id', 0)
+
+
+def run_worker(factory: Callable[[int, int], Application], index: int, workers: int, updates: multiprocessing.Queue) -> None:
+    """Entry point of a worker process: feed routed updates into its own Application."""
+    # A forked worker inherits the log queue but not the thread that writes it out
+    logs.configure_logging()
+    asyncio.run(_serve(factory(index, workers), updates))
+
+
+async def _serve(application: Application, updates: multiprocessing.Queue) -> None:
+    async with application:
+        # Run the same lifecycle hooks run_polling would
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        while True:
+            data = await asyncio.to_thread(updates.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+class TelegramIngress:
+    """Receives Telegram webhook updates and fans them out to worker processes.
+
+    Every update from a user goes to worker `user_id % workers`, and each worker
+    handles its updates one at a time, so per-user ordering is preserved while
+    different users are served in parallel. The worker index doubles as the
+    persistence shard, which is keyed by the same user id, so a worker never drops
+    an update it was routed, including staff commands sent from a group.
+    """
+
+    def __init__(self, factory: Callable[[int, int], Application], workers: Optional[int] = None, secret_token: Optional[str] = None):
+        config = settings()
+        workers = workers or config.telegram_workers
+        self.factory = factory
+        self.secret_token = config.telegram_webhook_secret if secret_token is None else secret_token
+        self.queues: List[multiprocessing.Queue] = [multiprocessing.Queue() for _ in range(workers)]
+        self.processes: List[multiprocessing.Process] = []
+
+    def start(self) -> None:
+        for index, updates in enumerate(self.queues):
+            process = multiprocessing.Process(
+                target=run_worker,
+                args=(self.factory, index, len(self.queues), updates),
+                name=f'telegram-worker-{index}',
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+
+    def stop(self) -> None:
+        for updates in self.queues:
+            updates.put(None)
+        for process in self.processes:
+            process.join()
+
+    def verify(self, secret_token: Optional[str]) -> bool:
+        if not self.secret_token:
+            return True
+        return secret_token is not None and hmac.compare_digest(secret_token, self.secret_token)
+
+    def dispatch(self, body: bytes) -> None:
+        update = json.loads(body)
+        self.queues[routing_key(update) % len(self.queues)].put(update)
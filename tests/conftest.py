@@ -0,0 +1,25 @@
+import os
+import sys
+
+import mongomock
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+import schema
+
+# Every test talks to an in-memory MongoDB; nothing here needs a server
+database._client = mongomock.MongoClient()
+
+
+@pytest.fixture
+def db():
+    """A freshly indexed, empty database, with the process-local caches cleared."""
+    mongo = database.get_db()
+    for name in mongo.list_collection_names():
+        mongo.drop_collection(name)
+    schema.ensure_indexes(mongo)
+    database.ledger._recent.clear()
+    database.catalog.invalidate()
+    yield mongo
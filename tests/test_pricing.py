@@ -0,0 +1,84 @@
+import random
+from decimal import (
+    Decimal,
+    ROUND_HALF_UP
+)
+
+from pricing import (
+    format_amount,
+    to_cents,
+    PricingEngine
+)
+
+# Seeded so a failure reproduces
+CASES = 2000
+PRODUCTS = ('Sourdough', 'Rye', 'Baguette', 'Croissant')
+
+
+def random_engine(rng: random.Random) -> PricingEngine:
+    discounts = tuple((rng.randint(2, 30), rng.randint(1, 50)) for _ in range(rng.randint(0, 3)))
+    return PricingEngine(delivery_fee=rng.randint(0, 1000), pickup_fees={'santos-o-velho': rng.randint(0, 300)}, discounts=discounts)
+
+
+def random_lines(rng: random.Random):
+    return [
+        {'product': product, 'quantity': rng.randint(1, 40), 'price': round(rng.uniform(0.01, 50), rng.choice((0, 1, 2)))}
+        for product in rng.sample(PRODUCTS, rng.randint(1, len(PRODUCTS)))
+    ]
+
+
+def test_quote_total_is_what_stripe_charges():
+    rng = random.Random(20)
+    for _ in range(CASES):
+        engine = random_engine(rng)
+        option, location = rng.choice((('delivery', 'Rua Augusta 1'), ('pickup', 'santos-o-velho'), ('pickup', 'elsewhere')))
+        quote = engine.quote(random_lines(rng), option, location)
+
+        charged = sum(line.unit_amount * line.quantity for line in quote.lines)
+        assert charged + quote.fee == quote.total
+        assert all(line.amount == line.unit_amount * line.quantity for line in quote.lines)
+
+
+def test_fee_is_charged_once_per_order():
+    rng = random.Random(21)
+    for _ in range(CASES):
+        engine = random_engine(rng)
+        lines = random_lines(rng)
+        single = engine.quote(lines[:1], 'delivery', 'Rua Augusta 1')
+        full = engine.quote(lines, 'delivery', 'Rua Augusta 1')
+
+        assert single.fee == full.fee == engine.delivery_fee
+        assert full.total - full.fee == sum(line.amount for line in full.lines)
+
+
+def test_discounts_never_raise_a_price():
+    rng = random.Random(22)
+    for _ in range(CASES):
+        engine = random_engine(rng)
+        quote = engine.quote(random_lines(rng), 'pickup', 'santos-o-velho')
+
+        assert quote.discount >= 0
+        for line in quote.lines:
+            assert line.discount >= 0
+            assert 0 <= line.unit_amount <= line.list_amount
+            assert line.amount + line.discount == line.list_amount * line.quantity
+
+
+def test_to_cents_matches_decimal_rounding():
+    rng = random.Random(23)
+    for _ in range(CASES):
+        # Prices with up to three decimals, built from integer thousandths of a euro
+        millis = rng.randint(0, 10 ** 6)
+        price = f"{millis // 1000}.{millis % 1000:03d}"
+        expected = (millis + 5) // 10
+        assert to_cents(price) == expected
+        assert to_cents(float(price)) == expected
+        assert to_cents(Decimal(price)) == int((Decimal(price) * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+
+def test_to_cents_does_not_truncate_floats():
+    # 2.3 * 100 == 229.99999999999997 in binary floating point
+    assert to_cents(2.3) == 230
+    assert to_cents(4.35) == 435
+    assert to_cents(0.005) == 1
+    assert format_amount(to_cents(2.3)) == '€2.30'
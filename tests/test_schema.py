@@ -0,0 +1,53 @@
+import os
+
+import pymongo
+import pytest
+from pymongo.errors import (
+    PyMongoError
+)
+
+import schema
+
+# explain() plans need a real server; point this at a scratch instance to run the check
+MONGO_TEST_URI = os.environ.get('MONGO_TEST_URI', 'mongodb://localhost:27017')
+
+
+@pytest.fixture
+def mongod():
+    client = pymongo.MongoClient(MONGO_TEST_URI, serverSelectionTimeoutMS=500)
+    try:
+        client.admin.command('ping')
+    except PyMongoError:
+        pytest.skip(f"no MongoDB server at {MONGO_TEST_URI}")
+    client.drop_database('order_bot_test_schema')
+    yield client['order_bot_test_schema']
+    client.drop_database('order_bot_test_schema')
+    client.close()
+
+
+def test_hot_queries_use_an_index(mongod):
+    schema.bootstrap(mongod)
+
+    assert schema.collection_scans(mongod) == []
+
+
+def test_migrate_applies_each_migration_once(db):
+    db['orders'].insert_one({'product': 'Sourdough', 'quantity': 2})
+
+    schema.migrate(db)
+    schema.migrate(db)
+
+    assert db['migrations'].count_documents({}) == len(schema.MIGRATIONS)
+    assert db['orders'].find_one({})['items'] == [{'product': 'Sourdough', 'quantity': 2}]
+
+
+def test_migrate_tolerates_a_concurrent_bootstrap(db, monkeypatch):
+    # Another worker records the migration between our read and our insert
+    def record_elsewhere(mongo):
+        mongo['migrations'].insert_one({'_id': '0001_legacy_orders'})
+
+    monkeypatch.setattr(schema, 'MIGRATIONS', [('0001_legacy_orders', record_elsewhere)])
+
+    schema.migrate(db)
+
+    assert db['migrations'].count_documents({}) == 1
@@ -0,0 +1,29 @@
+from persistence import (
+    shard_of
+)
+from telegram_ingress import (
+    routing_key
+)
+
+WORKERS = 4
+
+
+def test_group_commands_reach_the_worker_that_owns_the_sender():
+    # /report sent by a staff member in the staff group
+    update = {
+        'update_id': 1,
+        'message': {'message_id': 1, 'text': '/report', 'chat': {'id': -1001234567890, 'type': 'supergroup'}, 'from': {'id': 4242}},
+    }
+
+    assert routing_key(update) % WORKERS == shard_of(4242, WORKERS)
+
+
+def test_callback_queries_are_routed_by_the_user():
+    update = {'update_id': 2, 'callback_query': {'id': 'q', 'from': {'id': 77}, 'message': {'chat': {'id': -5}}}}
+
+    assert routing_key(update) == 77
+
+
+def test_updates_without_a_sender_fall_back_to_the_chat():
+    assert routing_key({'update_id': 3, 'channel_post': {'chat': {'id': -100}}}) == -100
+    assert routing_key({'update_id': 4}) == 4
@@ -0,0 +1,162 @@
+import json
+import threading
+from typing import (
+    Callable, Dict, List, Optional
+)
+
+import database
+from cart import (
+    encode_items
+)
+from webhooks import (
+    handle_event,
+    WebhookQueue,
+    DONE
+)
+
+THREADS = 16
+
+
+def run_concurrently(target: Callable[[], object], threads: int = THREADS) -> List:
+    """Call `target` from `threads` threads released at the same moment."""
+    barrier = threading.Barrier(threads)
+    results = []
+
+    def run() -> None:
+        barrier.wait()
+        results.append(target())
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return results
+
+
+def completed_event(event_id: str, items: List[Dict], reservation_id: Optional[str] = None, payment_intent: str = 'pi_1') -> Dict:
+    metadata = {'option': 'pickup', 'location': 'santos-o-velho', 'name': 'Ana', 'items': encode_items(items)}
+    if reservation_id is not None:
+        metadata['reservation_id'] = reservation_id
+    return {
+        'id': event_id,
+        'type': 'checkout.session.completed',
+        'data': {'object': {
+            'payment_intent': payment_intent,
+            'client_reference_id': reservation_id,
+            'amount_total': 900,
+            'metadata': metadata,
+        }},
+    }
+
+
+def stock(db, name: str) -> int:
+    return db['products'].find_one({'name': name})['stock']
+
+
+def test_completed_claim_is_refused(db):
+    assert database.ledger.claim('evt_1', 'pi_1')
+    database.ledger.complete('evt_1')
+
+    claims = run_concurrently(lambda: database.ledger.claim('evt_1', 'pi_1'))
+
+    assert claims.count(True) == 0
+    assert db['processed_events'].count_documents({}) == 1
+
+
+def test_claim_refuses_a_second_event_for_a_completed_payment(db):
+    assert database.ledger.claim('evt_1', 'pi_1')
+    database.ledger.complete('evt_1')
+
+    assert not database.ledger.claim('evt_2', 'pi_1')
+
+
+def test_concurrent_deliveries_create_one_order(db):
+    db['products'].insert_one({'name': 'Sourdough', 'price': 4.5, 'stock': 10})
+    event = completed_event('evt_1', [{'product': 'Sourdough', 'quantity': 2}])
+
+    run_concurrently(lambda: handle_event(event))
+
+    assert db['orders'].count_documents({}) == 1
+    assert stock(db, 'Sourdough') == 8
+
+
+def test_concurrent_deliveries_commit_the_reservation_once(db):
+    db['products'].insert_one({'name': 'Sourdough', 'price': 4.5, 'stock': 10})
+    items = [{'product': 'Sourdough', 'quantity': 2}]
+    reservation_id = database.reservations.reserve(items)
+    event = completed_event('evt_1', items, reservation_id)
+
+    run_concurrently(lambda: handle_event(event))
+
+    assert db['orders'].count_documents({}) == 1
+    assert stock(db, 'Sourdough') == 8
+    assert db['reservations'].find_one({'_id': reservation_id})['status'] == 'committed'
+
+
+def test_retried_order_is_completed_once(db, monkeypatch):
+    db['products'].insert_one({'name': 'Sourdough', 'price': 4.5, 'stock': 10})
+    event = completed_event('evt_1', [{'product': 'Sourdough', 'quantity': 2}])
+
+    # The first attempt inserts the order and then fails before the rollup
+    def fail(*args):
+        raise RuntimeError('rollup failed')
+
+    monkeypatch.setattr(database, 'record_order', fail)
+    try:
+        handle_event(event)
+    except RuntimeError:
+        pass
+    monkeypatch.undo()
+
+    # Stripe redelivers; the retry finishes the order instead of failing on the duplicate
+    handle_event(event)
+    handle_event(event)
+
+    assert db['orders'].count_documents({}) == 1
+    assert stock(db, 'Sourdough') == 8
+    assert db['daily_orders'].find_one({})['orders'] == 1
+
+
+def test_short_stock_marks_the_order_oversold(db):
+    db['products'].insert_many([
+        {'id': '1', 'name': 'Sourdough', 'price': 4.5, 'stock': 10},
+        {'id': '2', 'name': 'Rye', 'price': 3.0, 'stock': 1},
+    ])
+    event = completed_event('evt_1', [{'product': 'Sourdough', 'quantity': 2}, {'product': 'Rye', 'quantity': 2}])
+
+    handle_event(event)
+
+    assert db['orders'].find_one({})['status'] == 'oversold'
+    # Nothing is taken for a partially available order
+    assert stock(db, 'Sourdough') == 10
+    assert stock(db, 'Rye') == 1
+
+
+def test_pending_event_with_a_stale_claim_is_processed(db):
+    db['products'].insert_one({'name': 'Sourdough', 'price': 4.5, 'stock': 10})
+    event = completed_event('evt_1', [{'product': 'Sourdough', 'quantity': 2}])
+
+    # A worker claimed the event and died before creating the order
+    database.ledger.claim('evt_1', 'pi_1')
+    db['webhook_events'].insert_one({'_id': 'evt_1', 'type': event['type'], 'payload': json.dumps(event), 'status': 'pending', 'attempts': 0})
+
+    queue = WebhookQueue(db['webhook_events'], workers=1)
+    queue.start()
+    queue.queue.join()
+
+    assert db['webhook_events'].find_one({'_id': 'evt_1'})['status'] == DONE
+    assert db['orders'].count_documents({}) == 1
+    assert stock(db, 'Sourdough') == 8
+    assert db['processed_events'].find_one({'_id': 'evt_1'})['status'] == 'done'
+
+
+def test_reports_record_the_amount_charged_at_checkout(db):
+    db['products'].insert_one({'name': 'Sourdough', 'price': 4.5, 'stock': 10})
+    # Charged €4.00 a unit at checkout; the price went up before the payment arrived
+    event = completed_event('evt_1', [{'product': 'Sourdough', 'quantity': 2, 'unit_amount': 400}])
+
+    handle_event(event)
+
+    assert db['orders'].find_one({})['items'][0]['unit_amount'] == 400
+    assert db['daily_sales'].find_one({})['revenue_cents'] == 800
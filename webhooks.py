@@ -0,0 +1,242 @@
+import json
+import queue
+import logging
+import datetime
+import threading
+from collections import (
+    OrderedDict
+)
+from typing import (
+    Callable, Dict, List, Optional
+)
+import logs
+from pymongo import (
+    WriteConcern
+)
+from pymongo.errors import (
+    DuplicateKeyError
+)
+import database
+from metrics import (
+    Counter,
+    registry,
+    timed
+)
+from cart import (
+    decode_items
+)
+from config import (
+    settings
+)
+from payments import (
+    checkout
+)
+
+logger = logging.getLogger(__name__)
+
+# Event lifecycle in the webhook_events collection
+PENDING, DONE, FAILED = 'pending', 'done', 'failed'
+
+# Metadata every order needs from the checkout session
+ORDER_FIELDS = ('option', 'location', 'name')
+
+# Recently retrieved payment intent metadata, for sessions created without it
+METADATA_CACHE_SIZE = 1000
+_metadata_cache: OrderedDict = OrderedDict()
+_metadata_lock = threading.Lock()
+
+# Stripe API calls made while turning checkout sessions into orders
+orders_created = registry.register('counter', 'webhook_orders_created', 'Orders created from checkout sessions', Counter())
+stripe_api_calls = registry.register('counter', 'webhook_stripe_api_calls', 'Stripe API calls made while creating orders', Counter())
+
+
+@timed('webhook_event_seconds', 'Stripe webhook event processing latency')
+def handle_event(event: Dict) -> None:
+    logger.debug("Handling %s event %s", event['type'], event['id'])
+    event_type = event['type']
+
+    if event_type == 'checkout.session.completed':
+        checkout_session = event['data']['object']
+        payment_intent_id = checkout_session['payment_intent']
+
+        # Stripe redelivers events; only the first delivery of a payment becomes an order
+        if not database.ledger.claim(event['id'], payment_intent_id):
+            return
+
+        try:
+            create_order(event['id'], checkout_session)
+        except Exception:
+            database.ledger.release(event['id'])
+            raise
+        database.ledger.complete(event['id'])
+
+    elif event_type == 'checkout.session.expired':
+        # The customer never paid, give the held stock back
+        checkout_session = event['data']['object']
+        reservation_id = checkout_session.get('client_reference_id')
+        if reservation_id:
+            database.reservations.release(reservation_id)
+
+    else:
+        logger.debug('Unhandled event type: %s', event_type)
+
+
+def create_order(event_id: str, checkout_session: Dict) -> None:
+    payment_intent_id = checkout_session['payment_intent']
+
+    # The session carries the order metadata; only ask Stripe when it is incomplete
+    metadata = checkout_session.get('metadata') or {}
+    api_calls = 0
+    if not all(field in metadata for field in ORDER_FIELDS):
+        metadata = payment_intent_metadata(payment_intent_id)
+        api_calls += 1
+
+    option = metadata['option']
+    location = metadata['location']
+    name = metadata['name']
+    reservation_id = metadata.get('reservation_id') or checkout_session.get('client_reference_id')
+    items = order_items(metadata, reservation_id)
+
+    # Perform desired actions with the cart & more; in this case add the order to the database
+    with logs.bind(order_id=reservation_id):
+        database.add_order(items, option, location, name, reservation_id, payment_intent_id, checkout_session.get('amount_total'))
+
+        orders_created.inc()
+        stripe_api_calls.inc(api_calls)
+        logger.debug("Order for event %s cost %d Stripe API call(s)", event_id, api_calls)
+
+
+def order_items(metadata: Dict, reservation_id: Optional[str]) -> List[Dict]:
+    """The cart lines of an order, from metadata or, for very large carts, the reservation."""
+    if 'items' in metadata:
+        return decode_items(metadata['items'])
+    if 'product' in metadata:
+        # Single-product sessions created before carts existed
+        return [{'product': metadata['product'], 'quantity': int(metadata['quantity'])}]
+
+    reservation = database.reservations.reservations.find_one({"_id": reservation_id}, {"items": 1})
+    return reservation['items']
+
+
+def payment_intent_metadata(payment_intent_id: str) -> Dict:
+    """Fetch a payment intent's metadata, remembering recent answers."""
+    with _metadata_lock:
+        metadata = _metadata_cache.get(payment_intent_id)
+    if metadata is not None:
+        return metadata
+
+    # Retrieve the payment_intent object
+    payment_intent = retrieve_payment_intent(payment_intent_id)
+    metadata = dict(payment_intent['metadata'])
+
+    with _metadata_lock:
+        _metadata_cache[payment_intent_id] = metadata
+        if len(_metadata_cache) > METADATA_CACHE_SIZE:
+            _metadata_cache.popitem(last=False)
+    return metadata
+
+
+@timed('stripe_payment_intent_retrieve_seconds', 'Stripe PaymentIntent.retrieve latency')
+def retrieve_payment_intent(payment_intent_id: str):
+    return checkout.stripe().PaymentIntent.retrieve(payment_intent_id)
+
+
+def verify_event(payload: bytes, signature: Optional[str]) -> Optional[Dict]:
+    """Parse a Stripe webhook, or return None if its signature doesn't check out."""
+    stripe = checkout.stripe()
+    try:
+        return stripe.Webhook.construct_event(payload, signature, settings().stripe_webhook_secret)
+    except stripe.SignatureVerificationError as e:
+        logger.warning("Signature verification failed: %s", e)
+        return None
+
+
+def api_calls_per_order() -> float:
+    """Average number of Stripe API calls spent building each order."""
+    if not orders_created.value:
+        return 0.0
+    return stripe_api_calls.value / orders_created.value
+
+
+class WebhookQueue:
+    """Durable hand-off between the webhook ingress and a pool of worker threads.
+
+    `enqueue` writes the verified payload to the webhook_events collection with a
+    journaled write and returns, so the HTTP request can be acknowledged right away.
+    Workers process events off the hot path and retry failures with backoff; events
+    still pending when the process stops are picked up again by `start`, and an event
+    that ran out of attempts is retried afresh when Stripe redelivers it.
+    """
+
+    def __init__(self, events, handler: Callable[[Dict], None] = handle_event, workers: int = 4, max_attempts: int = 5):
+        self.events = events.with_options(write_concern=WriteConcern(w=1, j=True))
+        self.handler = handler
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.queue: queue.Queue = queue.Queue()
+        self.threads = []
+        registry.gauge('webhook_queue_depth', 'Stripe events waiting for a worker', self.queue.qsize)
+
+    def enqueue(self, event_id: str, event_type: str, payload: str) -> None:
+        try:
+            self.events.insert_one({
+                "_id": event_id,
+                "type": event_type,
+                "payload": payload,
+                "status": PENDING,
+                "attempts": 0,
+                "received_at": datetime.datetime.utcnow(),
+            })
+        except DuplicateKeyError:
+            # Stripe redelivered an event we already hold. One that exhausted its retries
+            # gets a fresh set, since Stripe's redelivery is often the only retry left.
+            failed = self.events.find_one_and_update(
+                {"_id": event_id, "status": FAILED},
+                {"$set": {"status": PENDING, "attempts": 0, "payload": payload}},
+                {"_id": 1},
+            )
+            database.ledger.remember(event_id)
+            if failed is not None:
+                logger.info("Re-queued failed webhook event %s on redelivery", event_id)
+                self.queue.put((event_id, payload))
+            return
+        database.ledger.remember(event_id)
+        self.queue.put((event_id, payload))
+
+    def start(self) -> None:
+        # Recover events accepted before the last shutdown
+        for event in self.events.find({"status": PENDING}, {"payload": 1}):
+            self.queue.put((event['_id'], event['payload']))
+
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'webhook-worker-{index}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self) -> None:
+        while True:
+            event_id, payload = self.queue.get()
+            try:
+                self.handler(json.loads(payload))
+            except Exception:
+                logger.exception("Failed to process webhook event %s", event_id)
+                self._retry(event_id, payload)
+            else:
+                self.events.update_one({"_id": event_id}, {"$set": {"status": DONE, "processed_at": datetime.datetime.utcnow()}})
+            finally:
+                self.queue.task_done()
+
+    def _retry(self, event_id: str, payload: str) -> None:
+        event = self.events.find_one_and_update({"_id": event_id}, {"$inc": {"attempts": 1}}, {"attempts": 1})
+        attempts = event['attempts'] + 1 if event else self.max_attempts
+
+        if attempts >= self.max_attempts:
+            self.events.update_one({"_id": event_id}, {"$set": {"status": FAILED}})
+            # Let Stripe's next redelivery past the duplicate check so enqueue can re-queue it
+            database.ledger.forget(event_id)
+            return
+
+        # Exponential backoff: 2s, 4s, 8s, ...
+        timer = threading.Timer(2 ** attempts, self.queue.put, args=((event_id, payload),))
+        timer.daemon = True
+        timer.start()